@@ -0,0 +1,175 @@
+# Evaluation of many parameter sets of one FilterTool class in a single query:
+# counts through conditional aggregation, and matching keys through a UNION of
+# bounded selects.
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+
+# the lowest of the databases' limits on the selects of a compound select
+# (SQLite's SQLITE_MAX_COMPOUND_SELECT) and on the parameters of a query
+# (SQLite's SQLITE_MAX_VARIABLE_NUMBER), and half of SQLite's limit on the
+# columns of a select; larger batches take several queries
+MAX_SELECTS = 500
+MAX_COLUMNS = 1000
+MAX_PARAMS = 999
+
+
+def chunk_parts(parts, max_parts, max_params=MAX_PARAMS):
+    """
+    split a list of (sql, params) tuples into lists of at most ``max_parts``
+    of them, with at most ``max_params`` parameters between them (unless a
+    single part has more)
+
+    """
+    chunks, chunk, count = [], [], 0
+    for sql, params in parts:
+        if chunk and (len(chunk) == max_parts or count + len(params) > max_params):
+            chunks.append(chunk)
+            chunk, count = [], 0
+        chunk.append((sql, params))
+        count += len(params)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def compile_sets(filtertool_class, param_sets, queryset=None):
+    """
+    return a FilterTool for each parameter set, with the Q object its filters
+    compile to (None if it can't match anything)
+
+    """
+    compiled = []
+    for params in param_sets:
+        filtertool = filtertool_class.from_params(params, queryset=queryset)
+        compiled.append((filtertool, filtertool.build_q(filtertool.get_filter_results())))
+    return compiled
+
+
+def condition_sql(queryset, q, connection):
+    """
+    return the SQL condition (and its params) which holds for the rows of
+    ``queryset``'s table matching ``q``: the WHERE clause of the filtered
+    query when it doesn't join other tables, or else a primary key subquery
+
+    """
+    query = queryset.model._default_manager.filter(q).query
+    compiler = query.get_compiler(connection=connection)
+    if len([alias for alias in query.tables if query.alias_refcount[alias]]) <= 1:
+        sql, params = query.where.as_sql(compiler.quote_name_unless_alias, connection)
+        return sql or '1 = 1', list(params)
+    query = queryset.model._default_manager.filter(q).values('pk').query
+    sql, params = query.get_compiler(connection=connection).as_sql()
+    opts = queryset.model._meta
+    qn = connection.ops.quote_name
+    return '%s.%s IN (%s)' % (qn(opts.db_table), qn(opts.pk.column), sql), list(params)
+
+
+def from_sql(queryset, connection):
+    """
+    return the FROM clause of the rows of ``queryset``, named after the
+    model's table so that conditions on the table apply to them
+
+    """
+    table = connection.ops.quote_name(queryset.model._meta.db_table)
+    query = queryset.query
+    if not query.where and not query.extra and len(query.tables) <= 1:
+        return table, []
+    # joins to many related rows would repeat rows
+    query = queryset.distinct().query
+    sql, params = query.get_compiler(connection=connection).as_sql()
+    return '(%s) %s' % (sql, table), list(params)
+
+
+def batch_counts(filtertool_class, param_sets, queryset=None):
+    """
+    return the number of rows matching each parameter set, counted with one
+    ``COUNT(CASE WHEN ... THEN 1 END)`` column per set (over several scans
+    when there are more columns or parameters than a query may have)
+
+    """
+    compiled = compile_sets(filtertool_class, param_sets, queryset)
+    if not compiled:
+        return []
+    queryset = compiled[0][0].queryset
+    if not hasattr(queryset, 'query'):
+        # filtered in memory
+        return [filtertool.count() for filtertool, q in compiled]
+    connection = connections[queryset.db]
+    columns = []
+    for filtertool, q in compiled:
+        try:
+            if q is None:
+                raise EmptyResultSet
+            sql, condition_params = condition_sql(queryset, q, connection)
+        except EmptyResultSet:
+            columns.append(('0', []))
+            continue
+        columns.append(('COUNT(CASE WHEN %s THEN 1 END)' % sql, condition_params))
+    table, table_params = from_sql(queryset, connection)
+    cursor = connection.cursor()
+    counts = []
+    for chunk in chunk_parts(columns, MAX_COLUMNS, MAX_PARAMS - len(table_params)):
+        params = []
+        for sql, condition_params in chunk:
+            params.extend(condition_params)
+        cursor.execute('SELECT %s FROM %s' % (', '.join([sql for sql, condition_params in chunk]),
+            table), params + table_params)
+        counts.extend(int(count) for count in cursor.fetchone())
+    return counts
+
+
+def select_pks(queryset, conditions, limit=100):
+    """
+    return the primary keys of the first ``limit`` rows (in primary key
+    order, every row when ``limit`` is None) of ``queryset`` matching each Q
+    object of ``conditions`` (None matching nothing), selected with a UNION
+    of one bounded select per condition (split into several queries when
+    there are more selects or parameters than a query may have)
+
+    """
+    results = [[] for _ in conditions]
+    if not hasattr(queryset, 'query'):
+        # filtered in memory
+        for ndx, q in enumerate(conditions):
+            if q is not None:
+                rows = queryset.filter(q).order_by('pk')[:limit]
+                results[ndx] = [row.pk for row in rows]
+        return results
+    connection = connections[queryset.db]
+    selects = []
+    for ndx, q in enumerate(conditions):
+        if q is None:
+            continue
+        query = queryset.filter(q).distinct().order_by('pk').values_list('pk')
+        if limit is not None:
+            query = query[:limit]
+        try:
+            sql, select_params = query.query.get_compiler(connection=connection).as_sql()
+        except EmptyResultSet:
+            continue
+        # a LIMIT inside a UNION needs a subquery of its own
+        selects.append(('SELECT %d, s%d.* FROM (%s) s%d' % (ndx, ndx, sql, ndx),
+            list(select_params)))
+    cursor = connection.cursor()
+    for chunk in chunk_parts(selects, MAX_SELECTS):
+        params = []
+        for sql, select_params in chunk:
+            params.extend(select_params)
+        cursor.execute(' UNION ALL '.join([sql for sql, select_params in chunk]), params)
+        for ndx, pk in cursor.fetchall():
+            results[ndx].append(pk)
+    for pks in results:
+        pks.sort()
+    return results
+
+
+def batch_pks(filtertool_class, param_sets, limit=100, queryset=None):
+    """
+    return the primary keys of the first ``limit`` rows (in primary key
+    order) matching each parameter set, as ``select_pks()`` does
+
+    """
+    compiled = compile_sets(filtertool_class, param_sets, queryset)
+    if not compiled:
+        return []
+    return select_pks(compiled[0][0].queryset, [q for filtertool, q in compiled], limit)
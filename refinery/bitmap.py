@@ -0,0 +1,227 @@
+# An in-process bitmap index over the choice-like fields of a FilterTool: each
+# row gets a slot, and each distinct value of each field a bitset (a python
+# long) with the bits of the slots of the rows holding it set.  Filtering on
+# the indexed fields becomes AND/OR of bitsets and facet counts popcounts.
+from binascii import hexlify
+
+from django.db.models import Q, ManyToManyField
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_save, post_delete
+
+from refinery.filters import BooleanFilter, ChoiceFilter, MultipleChoiceFilter, \
+    AllValuesFilter, DateRangeFilter
+from refinery.memory import plain
+from refinery.optimizer import split_lookup
+
+INDEXED_FILTERS = (BooleanFilter, ChoiceFilter, MultipleChoiceFilter, AllValuesFilter)
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+def bits_from_slots(slots):
+    """
+    return a bitset with the bits of ``slots`` set, without building it one
+    shift at a time
+
+    """
+    slots = list(slots)
+    if not slots:
+        return 0L
+    data = bytearray(max(slots) // 8 + 1)
+    for slot in slots:
+        data[slot // 8] |= 1 << (slot % 8)
+    data.reverse()
+    return long(hexlify(str(data)), 16)
+
+
+def slots_from_bits(bits):
+    digits = bin(bits)[:1:-1]
+    return [slot for slot, digit in enumerate(digits) if digit == '1']
+
+
+class BitmapIndex(object):
+    """
+    A bitmap index over the fields of ``filtertool_class`` filtered by a
+    BooleanFilter, ChoiceFilter, MultipleChoiceFilter or AllValuesFilter,
+    built from ``queryset`` (all the rows of the model by default) and kept
+    up to date as instances of the model are saved and deleted.  Keep a
+    reference to the index for as long as it is used; the signal handlers
+    don't keep it alive.
+
+    """
+    def __init__(self, filtertool_class, queryset=None):
+        self.model = filtertool_class._meta.model
+        if queryset is None:
+            queryset = self.model._default_manager.all()
+        self.queryset = queryset
+        self.fields = {}
+        for name, filter_ in filtertool_class.base_filters.items():
+            if not isinstance(filter_, INDEXED_FILTERS) or \
+                    isinstance(filter_, DateRangeFilter):
+                continue
+            try:
+                field = self.model._meta.get_field(filter_.name)
+            except FieldDoesNotExist:
+                # only local fields can be kept up to date from the signals
+                continue
+            if not isinstance(field, ManyToManyField):
+                self.fields[name] = field
+        self.build()
+        uid = 'refinery.bitmap:%s' % id(self)
+        post_save.connect(self.update, sender=self.model, dispatch_uid=uid)
+        post_delete.connect(self.delete, sender=self.model, dispatch_uid=uid)
+
+    def build(self):
+        """
+        (re)build the index from the queryset
+
+        """
+        names = self.fields.keys()
+        self.slots = {}
+        self.pks = []
+        self.bitmaps = dict((name, {}) for name in names)
+        values = dict((name, {}) for name in names)
+        columns = [self.fields[name].name for name in names]
+        for row in self.queryset.values_list('pk', *columns).iterator():
+            slot = self.slots[row[0]] = len(self.pks)
+            self.pks.append(row[0])
+            for name, value in zip(names, row[1:]):
+                values[name].setdefault(value, []).append(slot)
+        for name in names:
+            for value, slots in values[name].items():
+                self.bitmaps[name][value] = bits_from_slots(slots)
+        self.all = bits_from_slots(self.slots.values())
+        self._string_keys = {}
+
+    def update(self, sender, instance, **kwargs):
+        """
+        post_save handler which moves the bit of ``instance`` to the bitsets
+        of its current values, or leaves it out if it isn't (or is no longer)
+        one of the rows of the queryset
+
+        """
+        self.delete(sender, instance)
+        query = self.queryset.query
+        if (query.where or query.extra or query.low_mark or query.high_mark is not None) \
+                and not self.queryset.filter(pk=instance.pk).exists():
+            return
+        slot = self.slots.get(instance.pk)
+        if slot is None:
+            slot = self.slots[instance.pk] = len(self.pks)
+            self.pks.append(instance.pk)
+        bit = 1L << slot
+        for name, field in self.fields.items():
+            value = getattr(instance, field.attname)
+            bitmaps = self.bitmaps[name]
+            bitmaps[value] = bitmaps.get(value, 0L) | bit
+            self._string_keys.pop(name, None)
+        self.all |= bit
+
+    def delete(self, sender, instance, **kwargs):
+        slot = self.slots.get(instance.pk)
+        if slot is None:
+            return
+        mask = ~(1L << slot)
+        for bitmaps in self.bitmaps.values():
+            for value, bits in bitmaps.items():
+                if bits & ~mask:
+                    bitmaps[value] = bits & mask
+        self.all &= mask
+
+    def get_bitmap(self, name, value):
+        bitmaps = self.bitmaps[name]
+        value = plain(value)
+        if value not in bitmaps and isinstance(value, basestring):
+            # choice fields give strings for integer choices
+            if name not in self._string_keys:
+                self._string_keys[name] = dict((unicode(k), k)
+                    for k in bitmaps if k is not None)
+            value = self._string_keys[name].get(value)
+        return bitmaps.get(value, 0L)
+
+    def evaluate(self, q, name):
+        """
+        return the bitset of the rows matching ``q``, the Q object of the
+        filter ``name``, or None if it can't be answered from the index
+
+        """
+        path = self.fields[name].name
+        bits = None
+        for child in q.children:
+            if isinstance(child, Q):
+                child_bits = self.evaluate(child, name)
+            else:
+                child_path, lookup = split_lookup(child[0])
+                if child_path != path or lookup not in ('exact', 'in'):
+                    return None
+                if lookup == 'exact':
+                    child_bits = self.get_bitmap(name, child[1])
+                else:
+                    child_bits = 0L
+                    for value in child[1]:
+                        child_bits |= self.get_bitmap(name, value)
+            if child_bits is None:
+                return None
+            if bits is None:
+                bits = child_bits
+            elif q.connector == Q.AND:
+                bits &= child_bits
+            else:
+                bits |= child_bits
+        if bits is None:
+            bits = self.all
+        if q.negated:
+            return self.all & ~bits
+        return bits
+
+    def get_bits(self, filtertool):
+        """
+        return a dictionary mapping the names of the active filters of
+        ``filtertool`` to their bitsets; the filters which can't be answered
+        from the index are evaluated by the database together, under the
+        name None
+
+        """
+        bits = {}
+        rest = Q()
+        for name, q in filtertool.get_filter_results().items():
+            if name in self.fields:
+                bits[name] = self.evaluate(q, name)
+            if bits.get(name) is None:
+                bits.pop(name, None)
+                rest &= q
+        if rest:
+            pks = filtertool.queryset.filter(rest).values_list('pk', flat=True)
+            slots = self.slots
+            bits[None] = bits_from_slots(slots[pk] for pk in pks if pk in slots)
+        return bits
+
+    def filter(self, filtertool):
+        """
+        return the primary keys of the rows matching ``filtertool``
+
+        """
+        selected = self.all
+        for bits in self.get_bits(filtertool).values():
+            selected &= bits
+        return [self.pks[slot] for slot in slots_from_bits(selected)]
+
+    def facet_counts(self, filtertool):
+        """
+        return a dictionary mapping the name of every indexed filter to a
+        dictionary of the number of rows holding each of its values among
+        the rows matching every other active filter of ``filtertool``
+
+        """
+        bits = self.get_bits(filtertool)
+        counts = {}
+        for name in self.fields:
+            selected = self.all
+            for other, other_bits in bits.items():
+                if other != name:
+                    selected &= other_bits
+            counts[name] = dict((value, popcount(selected & value_bits))
+                for value, value_bits in self.bitmaps[name].items())
+        return counts
@@ -0,0 +1,314 @@
+import time
+from hashlib import md5
+from itertools import combinations
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.related import RelatedObject
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_str
+from django.utils.translation import get_language
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:
+    # Django < 1.5
+    from django.db.models.sql.constants import LOOKUP_SEP
+
+from refinery.filters import AllValuesFilter
+from refinery.memory import plain
+from refinery.optimizer import split_lookup
+
+FORM_CACHE_PREFIX = 'refinery:form'
+CHOICES_VERSION_PREFIX = 'refinery:choices-version'
+REFINE_CACHE_PREFIX = 'refinery:refine'
+# the most active filters whose subsets are looked up in the refinement cache
+REFINE_MAX_FILTERS = getattr(settings, 'REFINERY_REFINE_MAX_FILTERS', 6)
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def choices_version_key(model):
+    return '%s:%s' % (CHOICES_VERSION_PREFIX, model_label(model))
+
+
+def invalidate_choices(sender, **kwargs):
+    """
+    signal handler which bumps the choices version of the saved or deleted
+    model, invalidating every cached form which draws choices from it
+
+    """
+    key = choices_version_key(sender)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the version isn't in the cache, so no fragments depend on it
+        pass
+
+
+def invalidate_relations(sender, action, **kwargs):
+    """
+    signal handler which bumps the version of the intermediate model of a
+    many-to-many relation when rows are added to or removed from it
+
+    """
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_choices(sender)
+
+
+def register_choice_model(model):
+    uid = 'refinery.cache:%s' % model_label(model)
+    post_save.connect(invalidate_choices, sender=model, dispatch_uid=uid)
+    post_delete.connect(invalidate_choices, sender=model, dispatch_uid=uid)
+    if model._meta.auto_created:
+        # the rows of automatic intermediate models are only added and
+        # removed through the relation's manager
+        m2m_changed.connect(invalidate_relations, sender=model, dispatch_uid=uid)
+
+
+def path_models(model, path):
+    """
+    return the models whose rows following the lookup ``path`` from
+    ``model`` reads, including the intermediate models of many-to-many
+    relations
+
+    """
+    models = [model]
+    opts = model._meta
+    for name in path.split(LOOKUP_SEP):
+        try:
+            field, _, direct, m2m = opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            break
+        if isinstance(field, RelatedObject):
+            related, rel = field.model, field.field.rel
+        elif getattr(field, 'rel', None) is not None:
+            related, rel = field.rel.to, field.rel
+        else:
+            break
+        if isinstance(related, basestring):
+            # the related model isn't loaded yet
+            break
+        if m2m:
+            models.append(rel.through)
+        models.append(related)
+        opts = related._meta
+    return models
+
+
+def q_models(model, q):
+    """
+    return the set of the models whose rows the lookups of ``q`` read
+
+    """
+    models = set([model])
+    for child in q.children:
+        if isinstance(child, Q):
+            models.update(q_models(model, child))
+        else:
+            models.update(path_models(model, split_lookup(child[0])[0]))
+    return models
+
+
+def choice_models(filters, model=None):
+    """
+    return the models whose rows provide the choices of ``filters``, the
+    filters of a FilterTool of ``model``
+
+    """
+    models = set()
+    for filter_ in filters:
+        queryset = filter_.extra.get('queryset')
+        if queryset is not None:
+            models.add(queryset.model)
+        if isinstance(filter_, AllValuesFilter):
+            models.add(getattr(filter_, 'model', model))
+    models.discard(None)
+    return models
+
+
+def register_filtertool(filtertool_class):
+    """
+    connect the signal handlers which invalidate the cached forms and
+    refinements of ``filtertool_class``.  This is done as soon as its filters
+    are known, so that saves in every process which imports the class (and
+    not only those which have rendered its form) bump the versions.
+
+    """
+    opts = filtertool_class._meta
+    filters = filtertool_class.base_filters.values()
+    models = set()
+    if opts.form_cache_timeout is not None:
+        models.update(choice_models(filters, opts.model))
+    if opts.refine_cache_timeout is not None and opts.model is not None:
+        for filter_ in filters:
+            for name in getattr(filter_, 'fields', None) or [filter_.name]:
+                if name:
+                    models.update(path_models(opts.model, name))
+    for model in models:
+        register_choice_model(model)
+
+
+def choices_versions(models):
+    keys = sorted(choices_version_key(model) for model in models)
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # start from the current time so that a version which was evicted
+            # never comes back with the value of a stale fragment
+            cache.add(key, int(time.time() * 1000))
+            versions[key] = cache.get(key)
+    return [(key, versions[key]) for key in keys]
+
+
+def choice_sources(filtertool):
+    """
+    return a description of where each filter of ``filtertool`` takes its
+    choices from, which a FilterTool may narrow per instance (to the rows a
+    user may see, say)
+
+    """
+    sources = []
+    for name, filter_ in sorted(filtertool.filters.items()):
+        queryset = filter_.extra.get('queryset')
+        choices = filter_.extra.get('choices')
+        if queryset is not None:
+            try:
+                query = str(queryset.query)
+            except EmptyResultSet:
+                query = None
+            sources.append((name, query, filter_.extra.get('to_field_name')))
+        elif isinstance(choices, (list, tuple)):
+            sources.append((name, choices))
+    return sources
+
+
+def form_cache_key(filtertool, method):
+    """
+    build the cache key of a rendered form from the FilterTool class, the
+    form prefix, the submitted data, the active language, the choice
+    querysets of the filters and the version of every choice source
+
+    """
+    models = choice_models(filtertool.filters.values(), filtertool._meta.model)
+    for model in models:
+        register_choice_model(model)
+    data = filtertool.data
+    if hasattr(data, 'lists'):
+        items = data.lists()
+    else:
+        items = data.items()
+    parts = [
+        filtertool.__class__.__module__,
+        filtertool.__class__.__name__,
+        filtertool.form_prefix,
+        filtertool.is_bound,
+        get_language(),
+        method,
+        sorted(items),
+        choice_sources(filtertool),
+        choices_versions(models),
+    ]
+    digest = md5(smart_str(repr(parts))).hexdigest()
+    return '%s:%s' % (FORM_CACHE_PREFIX, digest)
+
+
+def canonical_q(q):
+    """
+    return a representation of ``q`` which is equal for equal filter values
+    
+    """
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            children.append(canonical_q(child))
+            continue
+        key, value = child
+        if isinstance(value, (list, tuple, set, frozenset, QuerySet)):
+            value = sorted(plain(v) for v in value)
+        else:
+            value = plain(value)
+        children.append((key, value))
+    return (q.connector, q.negated, children)
+
+
+def refine_cache_base(filtertool, results):
+    """
+    return the parts of the refinement cache keys shared by every subset of
+    the filters in ``results``: the FilterTool class, its queryset and the
+    version of every model the filters read
+
+    """
+    try:
+        query = str(filtertool.queryset.query)
+    except EmptyResultSet:
+        query = None
+    models = set([filtertool.queryset.model])
+    for q in results.values():
+        models.update(q_models(filtertool.queryset.model, q))
+    for model in models:
+        register_choice_model(model)
+    return [
+        filtertool.__class__.__module__,
+        filtertool.__class__.__name__,
+        query,
+        choices_versions(models),
+    ]
+
+
+def refine_cache_key(base, results, names):
+    """
+    build the cache key of the primary keys of the rows of the FilterTool's
+    queryset matching the filters ``names``, from ``refine_cache_base()`` and
+    their Q objects in ``results``
+    
+    """
+    parts = base + [sorted((name, canonical_q(results[name])) for name in names)]
+    digest = md5(smart_str(repr(parts))).hexdigest()
+    return '%s:%s' % (REFINE_CACHE_PREFIX, digest)
+
+
+def get_refinement(filtertool, results):
+    """
+    look up the cached primary keys of the rows matching the largest subset
+    of the filters in ``results``, returning them (or None) and the results
+    of the filters which still have to be applied
+    
+    """
+    names = sorted(results.keys())
+    if not names or len(names) > REFINE_MAX_FILTERS:
+        return None, results
+    base = refine_cache_base(filtertool, results)
+    keys = {}
+    for size in range(len(names), 0, -1):
+        for subset in combinations(names, size):
+            keys[refine_cache_key(base, results, subset)] = subset
+    cached = cache.get_many(keys.keys())
+    if not cached:
+        return None, results
+    # the most filters, then the fewest rows
+    key = max(cached, key=lambda k: (len(keys[k]), -len(cached[k])))
+    rest = results.copy()
+    for name in keys[key]:
+        del rest[name]
+    return cached[key], rest
+
+
+def store_refinement(filtertool, results, qs, timeout, max_size):
+    """
+    cache the primary keys of the rows of ``qs``, which match every filter
+    in ``results``, returning them or None if there are more than
+    ``max_size``
+    
+    """
+    pks = list(qs.values_list('pk', flat=True)[:max_size + 1])
+    if len(pks) > max_size:
+        return None
+    key = refine_cache_key(refine_cache_base(filtertool, results), results, results.keys())
+    cache.set(key, pks, timeout)
+    return pks
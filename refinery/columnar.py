@@ -0,0 +1,306 @@
+# Filtering of large in-memory snapshots stored column by column in NumPy
+# arrays.  The lookups of the Q objects built by FilterTool filters become
+# vectorized boolean masks over the columns, so no python code runs per row.
+import datetime
+from bisect import bisect_left, bisect_right
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+try:
+    from django.utils import timezone
+except ImportError:
+    # Django < 1.4
+    timezone = None
+
+from refinery.memory import get_values, plain
+from refinery.optimizer import split_lookup
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def field_kind(field):
+    if field.choices or isinstance(field, (models.CharField, models.TextField)):
+        return 'category'
+    if isinstance(field, (models.BooleanField, models.NullBooleanField)):
+        return 'bool'
+    if isinstance(field, models.DateTimeField):
+        return 'datetime'
+    if isinstance(field, models.DateField):
+        return 'date'
+    if isinstance(field, models.TimeField):
+        return 'time'
+    return 'number'
+
+
+def value_kind(value):
+    if isinstance(value, basestring):
+        return 'category'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, datetime.datetime):
+        return 'datetime'
+    if isinstance(value, datetime.date):
+        return 'date'
+    if isinstance(value, datetime.time):
+        return 'time'
+    return 'number'
+
+
+class Column(object):
+    """
+    The values of one field: numbers, booleans and temporal values as a
+    numeric array, and strings and choices dictionary encoded as the positions
+    of the values in the sorted list ``categories``, with -1 for None.
+
+    """
+    def __init__(self, kind, values):
+        self.kind = kind
+        self.null = numpy.array([v is None for v in values], dtype=bool)
+        if kind == 'category':
+            self.categories = sorted(set(v for v in values if v is not None))
+            codes = dict((v, ndx) for ndx, v in enumerate(self.categories))
+            self.values = numpy.array([codes.get(v, -1) for v in values], dtype=numpy.int64)
+        else:
+            dtype = kind == 'number' and numpy.float64 or numpy.int64
+            self.values = numpy.array([v is not None and self.encode(v) or 0
+                for v in values], dtype=dtype)
+
+    def encode(self, value):
+        """
+        convert a value to the number it is stored as
+
+        """
+        value = plain(value)
+        if isinstance(value, basestring) and self.kind in ('datetime', 'date', 'time'):
+            value = self.parse(value)
+        if self.kind == 'datetime':
+            if isinstance(value, datetime.datetime):
+                if timezone and timezone.is_aware(value):
+                    value = timezone.make_naive(value, timezone.utc)
+            else:
+                value = datetime.datetime.combine(value, datetime.time())
+            delta = value - EPOCH
+            return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        if self.kind == 'date':
+            if isinstance(value, datetime.datetime):
+                value = value.date()
+            return value.toordinal()
+        if self.kind == 'time':
+            return ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + \
+                value.microsecond
+        if self.kind == 'bool':
+            return int(bool(value))
+        return float(value)
+
+    def parse(self, value):
+        """
+        convert a string to the temporal value the database would compare it
+        as, such as the 'YYYY-MM-DD' bounds of a DateRangeFilter
+
+        """
+        if self.kind == 'time':
+            parsed = parse_time(value)
+        else:
+            parsed = parse_datetime(value) or parse_date(value)
+        if parsed is None:
+            raise ValueError("'%s' isn't a valid %s" % (value, self.kind))
+        return parsed
+
+    def category(self, value):
+        """
+        convert a value to the type of the categories, as choice fields give
+        strings for integer choices
+
+        """
+        value = plain(value)
+        if self.categories and isinstance(value, basestring) and \
+                isinstance(self.categories[0], (int, long)):
+            return int(value)
+        return value
+
+    def bounds(self, value):
+        """
+        return the (left, right) positions of ``value`` in the sorted
+        categories, between which its code would be
+
+        """
+        return bisect_left(self.categories, value), bisect_right(self.categories, value)
+
+    def compare(self, lookup, value):
+        """
+        return the mask of the rows whose value compares to ``value`` as
+        ``lookup`` says
+
+        """
+        if self.kind == 'category':
+            left, right = self.bounds(self.category(value))
+            if lookup == 'exact':
+                if left == right:
+                    return numpy.zeros(len(self.values), dtype=bool)
+                return self.values == left
+            if lookup == 'gt':
+                return self.values >= right
+            if lookup == 'gte':
+                return self.values >= left
+            if lookup == 'lt':
+                return ~self.null & (self.values < left)
+            if lookup == 'lte':
+                return ~self.null & (self.values < right)
+        value = self.encode(value)
+        if lookup == 'exact':
+            mask = self.values == value
+        elif lookup == 'gt':
+            mask = self.values > value
+        elif lookup == 'gte':
+            mask = self.values >= value
+        elif lookup == 'lt':
+            mask = self.values < value
+        else:
+            mask = self.values <= value
+        return ~self.null & mask
+
+    def lookup(self, lookup, value):
+        if lookup == 'isnull':
+            if value:
+                return self.null.copy()
+            return ~self.null
+        if lookup == 'exact' and value is None:
+            return self.null.copy()
+        if lookup in ('exact', 'gt', 'gte', 'lt', 'lte'):
+            return self.compare(lookup, value)
+        if lookup == 'range':
+            return self.compare('gte', value[0]) & self.compare('lte', value[1])
+        if lookup == 'in':
+            if self.kind == 'category':
+                codes = [self.bounds(self.category(v)) for v in value if v is not None]
+                codes = [left for left, right in codes if left != right]
+            else:
+                codes = [self.encode(v) for v in value if v is not None]
+            return ~self.null & numpy.in1d(self.values, codes)
+        if lookup == 'startswith' and self.kind == 'category':
+            value = unicode(value)
+            left = bisect_left(self.categories, value)
+            right = bisect_left(self.categories, value + u'\uffff')
+            return (self.values >= left) & (self.values < right)
+        raise NotImplementedError("The '%s' lookup can't be used on a %s column" %
+            (lookup, self.kind))
+
+
+class ColumnarBackend(object):
+    """
+    A snapshot of rows (model instances or dictionaries) which a FilterTool
+    can filter in place of a queryset, storing each of ``fields`` as a NumPy
+    array.  The kind of each column is taken from the fields of ``model`` or,
+    without one, from the type of its first value.  Filtering and ordering
+    return a backend sharing the columns, holding the positions of its rows.
+
+    """
+    def __init__(self, rows, fields=None, model=None):
+        if numpy is None:
+            raise ImproperlyConfigured("ColumnarBackend requires NumPy")
+        self.rows = list(rows)
+        self.model = model
+        if fields is None:
+            fields = [f.name for f in model._meta.fields]
+        self.columns = {}
+        for name in fields:
+            values = [plain(get_values(row, name)[0]) for row in self.rows]
+            self.columns[name] = Column(self.get_kind(name, values), values)
+        self.positions = numpy.arange(len(self.rows))
+
+    def get_kind(self, name, values):
+        if self.model is not None:
+            try:
+                return field_kind(self.model._meta.get_field(name))
+            except FieldDoesNotExist:
+                pass
+        for value in values:
+            if value is not None:
+                return value_kind(value)
+        return 'number'
+
+    def _clone(self, positions):
+        clone = object.__new__(ColumnarBackend)
+        clone.__dict__.update(self.__dict__)
+        clone.positions = positions
+        return clone
+
+    def __iter__(self):
+        rows = self.rows
+        return (rows[ndx] for ndx in self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, ndx):
+        if isinstance(ndx, slice):
+            return self._clone(self.positions[ndx])
+        return self.rows[self.positions[ndx]]
+
+    def all(self):
+        return self._clone(self.positions)
+
+    def none(self):
+        return self._clone(self.positions[:0])
+
+    def count(self):
+        return len(self.positions)
+
+    def iterator(self):
+        return iter(self)
+
+    def mask(self, q):
+        """
+        return the boolean array of the rows matching ``q``
+
+        """
+        mask = None
+        for child in q.children:
+            if isinstance(child, Q):
+                child_mask = self.mask(child)
+            else:
+                path, lookup = split_lookup(child[0])
+                try:
+                    column = self.columns[path]
+                except KeyError:
+                    raise NotImplementedError("There is no '%s' column" % path)
+                child_mask = column.lookup(lookup, child[1])
+            if mask is None:
+                mask = child_mask
+            elif q.connector == Q.AND:
+                mask = mask & child_mask
+            else:
+                mask = mask | child_mask
+        if mask is None:
+            mask = numpy.ones(len(self.rows), dtype=bool)
+        if q.negated:
+            return ~mask
+        return mask
+
+    def filter(self, *args, **kwargs):
+        mask = self.mask(Q(*args, **kwargs))
+        return self._clone(self.positions[mask[self.positions]])
+
+    def order_by(self, *fields):
+        keys = []
+        for field in fields:
+            column = self.columns[field.lstrip('-')]
+            values = column.values[self.positions]
+            # None sorts first, like SQLite
+            nulls = ~column.null[self.positions]
+            if field.startswith('-'):
+                values, nulls = -values, ~nulls
+            keys.extend([nulls, values])
+        if not keys:
+            return self.all()
+        # lexsort sorts by the last key first, and keeps ties in place
+        keys.reverse()
+        return self._clone(self.positions[numpy.lexsort(keys)])
@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.related import RelatedObject
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:
+    # Django < 1.5
+    from django.db.models.sql.constants import LOOKUP_SEP
+
+from refinery.optimizer import split_lookup
+
+# rough relative cost of each lookup type on an indexed column; lookups which
+# can't use an index (leading wildcards, functions of the column, regular
+# expressions) cost the most
+LOOKUP_COSTS = {
+    'exact': 1,
+    'iexact': 2,
+    'in': 1,
+    'gt': 1,
+    'gte': 1,
+    'lt': 1,
+    'lte': 1,
+    'range': 1,
+    'isnull': 1,
+    'startswith': 2,
+    'istartswith': 4,
+    'year': 4,
+    'month': 4,
+    'day': 4,
+    'week_day': 4,
+    'search': 4,
+    'contains': 8,
+    'icontains': 8,
+    'endswith': 8,
+    'iendswith': 8,
+    'regex': 20,
+    'iregex': 20,
+}
+LOOKUP_COSTS.update(getattr(settings, 'REFINERY_LOOKUP_COSTS', {}))
+DEFAULT_LOOKUP_COST = 1
+UNINDEXED_COST_FACTOR = getattr(settings, 'REFINERY_UNINDEXED_COST_FACTOR', 2)
+
+
+def lookup_cost(model, key):
+    """
+    return the (cost, joins) of a single lookup, where joins is the set of
+    relation paths the lookup has to join through
+
+    """
+    path, lookup = split_lookup(key)
+    parts = path.split(LOOKUP_SEP)
+    cost = LOOKUP_COSTS.get(lookup, DEFAULT_LOOKUP_COST)
+    joins = set()
+    opts = model._meta
+    for i, name in enumerate(parts):
+        try:
+            field, _, direct, m2m = opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            # e.g. the lookup is one this module doesn't know about
+            break
+        last = i == len(parts) - 1
+        if isinstance(field, RelatedObject) or m2m:
+            # reverse relations and many to many fields always need a join
+            joins.add(LOOKUP_SEP.join(parts[:i + 1]))
+            if isinstance(field, RelatedObject):
+                opts = field.opts
+            else:
+                opts = field.rel.to._meta
+        elif getattr(field, 'rel', None) is not None and not last:
+            joins.add(LOOKUP_SEP.join(parts[:i + 1]))
+            opts = field.rel.to._meta
+        elif last and not (field.db_index or field.unique):
+            cost *= UNINDEXED_COST_FACTOR
+    return cost, joins
+
+
+def query_cost(model, q):
+    """
+    return the (cost, joins) of a Q object: the sum of the costs of its
+    lookups and the set of relation paths they join through
+
+    """
+    cost = 0
+    joins = set()
+    for child in q.children:
+        if isinstance(child, Q):
+            child_cost, child_joins = query_cost(model, child)
+        else:
+            child_cost, child_joins = lookup_cost(model, child[0])
+        cost += child_cost
+        joins |= child_joins
+    return cost, joins
+
+
+def is_multivalued(model, path):
+    """
+    whether following ``path`` from ``model`` goes through a relation which
+    can join several rows to each row of ``model``
+    
+    """
+    opts = model._meta
+    for name in path.split(LOOKUP_SEP):
+        try:
+            field, _, direct, m2m = opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            return False
+        if isinstance(field, RelatedObject) or m2m:
+            return True
+        if getattr(field, 'rel', None) is None:
+            return False
+        opts = field.rel.to._meta
+    return False
+
+
+def has_multivalued_lookups(model, q):
+    for child in q.children:
+        if isinstance(child, Q):
+            if has_multivalued_lookups(model, child):
+                return True
+        elif is_multivalued(model, split_lookup(child[0])[0]):
+            return True
+    return False
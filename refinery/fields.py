@@ -1,8 +1,19 @@
 from django import forms
+from django.core.validators import EMPTY_VALUES
+from django.utils.encoding import force_unicode
 
 from refinery.widgets import RangeWidget, LookupTypeWidget
 
 
+def get_key_field(queryset, to_field_name=None):
+    """
+    return the model field which model choices of ``queryset`` are keyed on
+    """
+    if to_field_name:
+        return queryset.model._meta.get_field(to_field_name)
+    return queryset.model._meta.pk
+
+
 class BaseRangeField(forms.MultiValueField):
     """
     Base abstract class for range filters. Inheriting classes must
@@ -58,3 +69,98 @@ class LookupTypeField(forms.MultiValueField):
         return data_list
 
 
+
+
+class ValuesModelChoiceIterator(object):
+    """
+    Iterates over the choices of a ModelChoiceField using a ``values_list()``
+    query of the key and label fields, so rendering the choices neither
+    instantiates the model objects nor follows relations per object.
+    
+    ``label_field`` is a field name or lookup path, or a sequence of them which
+    are interpolated into ``label_format``.
+    """
+    def __init__(self, field, label_field, label_format=None):
+        self.field = field
+        if isinstance(label_field, basestring):
+            label_field = (label_field,)
+        self.label_fields = tuple(label_field)
+        if label_format is None:
+            label_format = u' '.join([u'%s'] * len(self.label_fields))
+        self.label_format = label_format
+    
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield (u"", self.field.empty_label)
+        key = get_key_field(self.field.queryset, self.field.to_field_name).attname
+        values = self.field.queryset.values_list(key, *self.label_fields)
+        # iterator() fetches the rows from the cursor in chunks
+        for row in values.iterator():
+            yield (row[0], self.label_format % tuple(force_unicode(v) for v in row[1:]))
+    
+    def __len__(self):
+        return self.field.queryset.count()
+
+
+class ValuesChoicesMixin(object):
+    """
+    Renders the choices of a model choice field with a
+    ValuesModelChoiceIterator when ``label_field`` is given.
+    """
+    def __init__(self, *args, **kwargs):
+        # must be set before the queryset, which builds the widget's choices
+        self.label_field = kwargs.pop('label_field', None)
+        self.label_format = kwargs.pop('label_format', None)
+        super(ValuesChoicesMixin, self).__init__(*args, **kwargs)
+    
+    def _get_choices(self):
+        if self.label_field and not hasattr(self, '_choices'):
+            return ValuesModelChoiceIterator(self, self.label_field, self.label_format)
+        return super(ValuesChoicesMixin, self)._get_choices()
+    
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+
+class ModelChoiceField(ValuesChoicesMixin, forms.ModelChoiceField):
+    pass
+
+
+class ModelMultipleChoiceField(ValuesChoicesMixin, forms.ModelMultipleChoiceField):
+    pass
+
+
+class TrustedModelChoiceField(ModelChoiceField):
+    """
+    A ModelChoiceField which only checks that the submitted value is a valid
+    key for the queryset's model, and cleans to that key instead of looking up
+    the object.
+    """
+    def to_python(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        try:
+            return get_key_field(self.queryset, self.to_field_name).to_python(value)
+        except forms.ValidationError:
+            raise forms.ValidationError(self.error_messages['invalid_choice'])
+
+
+class TrustedModelMultipleChoiceField(ModelMultipleChoiceField):
+    """
+    A ModelMultipleChoiceField which cleans to the list of submitted keys
+    without looking up the objects.
+    """
+    def clean(self, value):
+        if self.required and not value:
+            raise forms.ValidationError(self.error_messages['required'])
+        elif not self.required and not value:
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise forms.ValidationError(self.error_messages['list'])
+        key = get_key_field(self.queryset, self.to_field_name)
+        keys = []
+        for pk in value:
+            try:
+                keys.append(key.to_python(pk))
+            except forms.ValidationError:
+                raise forms.ValidationError(self.error_messages['invalid_pk_value'] % pk)
+        return keys
@@ -1,11 +1,23 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
 
 from django import forms
-from django.db.models import Q
+from django.core.validators import EMPTY_VALUES
+from django.db.models import Model, Q
+from django.db.models.query import QuerySet
 from django.db.models.sql.constants import QUERY_TERMS
+from django.utils import formats
+from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
+try:
+    from django.forms.util import from_current_timezone
+except ImportError:
+    # Django < 1.4
+    from_current_timezone = lambda value: value
 
-from refinery.fields import NumericRangeField, DateRangeField, TimeRangeField, LookupTypeField
+from refinery.fields import NumericRangeField, DateRangeField, TimeRangeField, \
+    LookupTypeField, ModelChoiceField, ModelMultipleChoiceField, \
+    TrustedModelChoiceField, TrustedModelMultipleChoiceField, get_key_field
 
 __all__ = [
     'Filter', 'CharFilter', 'BooleanFilter', 'ChoiceFilter',
@@ -18,17 +30,86 @@ __all__ = [
 LOOKUP_TYPES = sorted(QUERY_TERMS)
 
 
+def get_param(params, name, multiple=False):
+    """
+    return the value of a parameter from either a ``QueryDict`` or a plain
+    dictionary, as a list of values when ``multiple`` is True
+    
+    """
+    if multiple:
+        if hasattr(params, 'getlist'):
+            return params.getlist(name)
+        value = params.get(name)
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [value]
+    return params.get(name)
+
+
+def coerce_decimal(value):
+    try:
+        return Decimal(force_unicode(value).strip())
+    except InvalidOperation:
+        raise forms.ValidationError(_(u'Enter a number.'))
+
+
+def _coerce_temporal(value, format_key, convert, message):
+    if isinstance(value, (date, time)):
+        return value
+    value = force_unicode(value).strip()
+    for format in formats.get_format(format_key):
+        try:
+            return convert(datetime.strptime(value, format))
+        except ValueError:
+            continue
+    raise forms.ValidationError(message)
+
+
+def coerce_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return _coerce_temporal(value, 'DATE_INPUT_FORMATS',
+        lambda value: value.date(), _(u'Enter a valid date.'))
+
+
+def coerce_datetime(value):
+    if isinstance(value, datetime):
+        return from_current_timezone(value)
+    if isinstance(value, date):
+        return from_current_timezone(datetime(value.year, value.month, value.day))
+    return from_current_timezone(_coerce_temporal(value, 'DATETIME_INPUT_FORMATS',
+        lambda value: value, _(u'Enter a valid date/time.')))
+
+
+def coerce_time(value):
+    return _coerce_temporal(value, 'TIME_INPUT_FORMATS',
+        lambda value: value.time(), _(u'Enter a valid time.'))
+
+
+def coerce_boolean(value):
+    # accepts the values submitted by NullBooleanSelect as well as the
+    # usual spellings of true and false
+    return {
+        True: True, u'2': True, u'True': True, u'true': True,
+        False: False, u'3': False, u'False': False, u'false': False,
+    }.get(value, None)
+
+
 class Filter(object):
     creation_counter = 0
     field_class = forms.Field
+    coercer = staticmethod(force_unicode)
     
     def __init__(self, name=None, label=None, widget=None, action=None,
-        lookup_type='exact', required=False, **kwargs):
+        lookup_type='exact', required=False, allowed_lookups=None, **kwargs):
         self.name = name
         self.label = label
         if action:
             self.filter = action
         self.lookup_type = lookup_type
+        self.allowed_lookups = allowed_lookups
         self.widget = widget
         self.required = required
         self.extra = kwargs
@@ -36,23 +117,34 @@ class Filter(object):
         self.creation_counter = Filter.creation_counter
         Filter.creation_counter += 1
     
+    @property
+    def has_lookup_choices(self):
+        return self.lookup_type is None or isinstance(self.lookup_type, (list, tuple))
+    
+    def get_lookup_choices(self):
+        if not hasattr(self, '_lookup_choices'):
+            if self.lookup_type is None:
+                lookup = [(x, x) for x in LOOKUP_TYPES]
+            else:
+                # lookup = [(x, x) for x in LOOKUP_TYPES if x in self.lookup_type]
+                lookup = []
+                for x in self.lookup_type:
+                    if isinstance(x, (list, tuple)) and x[0] in LOOKUP_TYPES:
+                        lookup.append(x)
+                    elif x in LOOKUP_TYPES:
+                        lookup.append((x, x))
+            if self.allowed_lookups is not None:
+                lookup = [x for x in lookup if x[0] in self.allowed_lookups]
+            self._lookup_choices = lookup
+        return self._lookup_choices
+    
     @property
     def field(self):
         if not hasattr(self, '_field'):
-            if self.lookup_type is None or isinstance(self.lookup_type, (list, tuple)):
-                if self.lookup_type is None:
-                    lookup = [(x, x) for x in LOOKUP_TYPES]
-                else:
-                    # lookup = [(x, x) for x in LOOKUP_TYPES if x in self.lookup_type]
-                    lookup = []
-                    for x in self.lookup_type:
-                        if isinstance(x, (list, tuple)) and x[0] in LOOKUP_TYPES:
-                            lookup.append(x)
-                        elif x in LOOKUP_TYPES:
-                            lookup.append((x, x))
+            if self.has_lookup_choices:
                 self._field = LookupTypeField(self.field_class(
                     required=self.required, widget=self.widget, **self.extra),
-                    lookup, required=self.required, label=self.label)
+                    self.get_lookup_choices(), required=self.required, label=self.label)
             else:
                 self._field = self.field_class(required=self.required,
                     label=self.label, widget=self.widget, **self.extra)
@@ -75,6 +167,35 @@ class Filter(object):
         else:
             lookup = self.lookup_type
         return Q(**{'%s__%s' % (self.name, lookup): value})
+    
+    def coerce(self, value):
+        """
+        convert a single raw parameter value to the python value used for
+        filtering, raising ValidationError if it is invalid
+        
+        """
+        if value in EMPTY_VALUES:
+            return None
+        return self.coercer(value)
+    
+    def parse(self, params, name):
+        """
+        return the value to pass to ``filter()`` from the raw parameters,
+        without building a form field.  ``name`` is the (prefixed) parameter
+        name the filter's form field would use.
+        
+        """
+        if self.has_lookup_choices:
+            value = self.coerce(get_param(params, '%s_0' % name))
+            if value is None:
+                return None
+            lookup = get_param(params, '%s_1' % name)
+            if lookup and lookup not in dict(self.get_lookup_choices()):
+                raise forms.ValidationError(_(u'Select a valid lookup type.'))
+            return [value, lookup or '']
+        if self.required and get_param(params, name) in EMPTY_VALUES:
+            raise forms.ValidationError(_(u'This field is required.'))
+        return self.coerce(get_param(params, name))
 
 
 class CharFilter(Filter):
@@ -83,16 +204,42 @@ class CharFilter(Filter):
 
 class BooleanFilter(Filter):
     field_class = forms.NullBooleanField
+    coercer = staticmethod(coerce_boolean)
     
     def filter(self, value):
         return Q(**{self.name: bool(value)})
 
 
-class ChoiceFilter(Filter):
+class ChoiceMixin(object):
+    """
+    Validates submitted values against the filter's static choices.
+    
+    """
+    def get_valid_choices(self):
+        if not hasattr(self, '_valid_choices'):
+            valid = set()
+            for key, label in self.extra.get('choices', ()):
+                if isinstance(label, (list, tuple)):
+                    valid.update(force_unicode(k) for k, v in label)
+                else:
+                    valid.add(force_unicode(key))
+            self._valid_choices = valid
+        return self._valid_choices
+    
+    def coerce(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        value = force_unicode(value)
+        if value not in self.get_valid_choices():
+            raise forms.ValidationError(_(u'Select a valid choice.'))
+        return value
+
+
+class ChoiceFilter(ChoiceMixin, Filter):
     field_class = forms.ChoiceField
 
 
-class MultipleChoiceFilter(Filter):
+class MultipleChoiceFilter(ChoiceMixin, Filter):
     """
     This filter preforms an OR query on the selected options.
     
@@ -101,7 +248,7 @@ class MultipleChoiceFilter(Filter):
     
     def filter(self, value):
         value = value or ()
-        if len(value) and len(value) == len(self.field.choices):
+        if len(value) and self.all_selected(value):
             return
         
         lookup_type = self.lookup_type or 'exact'
@@ -110,6 +257,18 @@ class MultipleChoiceFilter(Filter):
         reducto = lambda x, y: x | Q(**{lookup: y})
         q = reduce(reducto, value, Q())
         return q
+    
+    def all_selected(self, value):
+        return len(value) == len(self.field.choices)
+    
+    def parse(self, params, name):
+        values = [v for v in get_param(params, name, multiple=True)
+            if v not in EMPTY_VALUES]
+        if not values:
+            if self.required:
+                raise forms.ValidationError(_(u'This field is required.'))
+            return None
+        return [self.coerce(v) for v in values]
 
 
 class MultipleFieldFilter(CharFilter):
@@ -134,30 +293,113 @@ class MultipleFieldFilter(CharFilter):
 
 class DateFilter(Filter):
     field_class = forms.DateField
+    coercer = staticmethod(coerce_date)
 
 
 class DateTimeFilter(Filter):
     field_class = forms.DateTimeField
+    coercer = staticmethod(coerce_datetime)
 
 
 class TimeFilter(Filter):
     field_class = forms.TimeField
+    coercer = staticmethod(coerce_time)
 
 
-class ModelChoiceFilter(Filter):
-    field_class = forms.ModelChoiceField
+def is_looked_up(value):
+    """
+    return True if ``value`` holds the related objects the form field looked
+    up in its queryset, rather than bare keys
+    
+    """
+    if isinstance(value, QuerySet):
+        return True
+    if isinstance(value, (list, tuple)):
+        return bool(value) and all(isinstance(v, Model) for v in value)
+    return isinstance(value, Model)
 
 
-class ModelMultipleChoiceFilter(MultipleChoiceFilter):
-    field_class = forms.ModelMultipleChoiceField
+class ModelChoiceMixin(object):
+    """
+    Coerces submitted values to the type of the related key without looking up
+    the related objects, which is all that is needed to filter on them.
+    
+    When ``trusted`` is True the form field does the same, so validating a
+    submitted key doesn't cost a query.  If the queryset limits the choices,
+    keys which weren't looked up in it (trusted ones, or those parsed without
+    a form) are then constrained to it with a subquery instead.
+    
+    """
+    trusted_field_class = None
+    
+    def __init__(self, *args, **kwargs):
+        self.trusted = kwargs.pop('trusted', False)
+        super(ModelChoiceMixin, self).__init__(*args, **kwargs)
+    
+    @property
+    def field(self):
+        if self.trusted and not hasattr(self, '_field'):
+            self.field_class = self.trusted_field_class
+        return super(ModelChoiceMixin, self).field
+    
+    def get_key_field(self):
+        return get_key_field(self.extra['queryset'], self.extra.get('to_field_name'))
+    
+    def coerce(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        try:
+            return self.get_key_field().to_python(value)
+        except forms.ValidationError:
+            raise forms.ValidationError(_(u'Select a valid choice.'))
+    
+    def filter(self, value):
+        q = super(ModelChoiceMixin, self).filter(value)
+        queryset = self.extra['queryset']
+        if q and queryset.query.where and not is_looked_up(value):
+            keys = queryset.values_list(self.get_key_field().name, flat=True)
+            q &= Q(**{'%s__in' % self.name: keys})
+        return q
+
+
+class ModelChoiceFilter(ModelChoiceMixin, Filter):
+    field_class = ModelChoiceField
+    trusted_field_class = TrustedModelChoiceField
+
+
+class ModelMultipleChoiceFilter(ModelChoiceMixin, MultipleChoiceFilter):
+    field_class = ModelMultipleChoiceField
+    trusted_field_class = TrustedModelMultipleChoiceField
+    
+    def all_selected(self, value):
+        if self.trusted or not is_looked_up(value):
+            # counting the choices would cost the query that trusting the
+            # submitted keys saves, and bare keys may not be choices at all
+            return False
+        return len(value) == self.extra['queryset'].count()
 
 
 class NumberFilter(Filter):
     field_class = forms.DecimalField
+    coercer = staticmethod(coerce_decimal)
+
+
+class BaseRangeMixin(object):
+    """
+    Parses the two bounds of a range the same way the filter's range field
+    compresses them, coercing each bound with ``coercer``.
+    
+    """
+    def parse(self, params, name):
+        bounds = [self.coerce(get_param(params, '%s_%s' % (name, i))) for i in (0, 1)]
+        if bounds == [None, None]:
+            return None
+        return slice(*bounds)
 
 
-class RangeFilter(Filter):
+class RangeFilter(BaseRangeMixin, Filter):
     field_class = NumericRangeField
+    coercer = staticmethod(coerce_decimal)
     
     def filter(self, value):
         if not value:
@@ -165,7 +407,7 @@ class RangeFilter(Filter):
         return Q(**{'%s__range' % self.name: (value.start, value.stop)})
 
 
-class BaseOpenRangeFilter(Filter):
+class BaseOpenRangeFilter(BaseRangeMixin, Filter):
     """
     Abstract class similar to RangeFilter but allows open ended ranges.
     Inheriting classes must define field_class attribute.
@@ -182,12 +424,15 @@ class BaseOpenRangeFilter(Filter):
 
 class OpenRangeNumericFilter(BaseOpenRangeFilter):
     field_class = NumericRangeField
+    coercer = staticmethod(coerce_decimal)
 
 class OpenRangeDateFilter(BaseOpenRangeFilter):
     field_class = DateRangeField
+    coercer = staticmethod(coerce_date)
 
 class OpenRangeTimeFilter(BaseOpenRangeFilter):
     field_class = TimeRangeField
+    coercer = staticmethod(coerce_time)
 
 
 class DateRangeFilter(ChoiceFilter):
@@ -231,4 +476,9 @@ class AllValuesFilter(ChoiceFilter):
         qs = self.model._default_manager.distinct().order_by(self.name).values_list(self.name, flat=True)
         self.extra['choices'] = [(o, o) for o in qs]
         return super(AllValuesFilter, self).field
+    
+    def coerce(self, value):
+        # the choices are every value in the database, so there is nothing
+        # worth checking without a query
+        return Filter.coerce(self, value)
 
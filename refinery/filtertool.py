@@ -1,10 +1,15 @@
 # start more flexible version
+from __future__ import with_statement
 from copy import deepcopy
 
 from django import forms
+from django.conf import settings
+from django.core.cache import cache
+from django.core.validators import EMPTY_VALUES
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, Count
 from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import EmptyQuerySet
 from django.db.models.related import RelatedObject
 try:
     from django.db.models.constants import LOOKUP_SEP
@@ -13,13 +18,32 @@ except ImportError:
     from django.db.models.sql.constants import LOOKUP_SEP
 from django.db.models.sql.constants import QUERY_TERMS
 from django.utils.datastructures import SortedDict
+from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 
+from refinery import registry
+from refinery.batch import batch_counts, batch_pks
+from refinery.cache import form_cache_key, get_refinement, store_refinement, \
+    register_filtertool
+from refinery.cost import query_cost, is_multivalued, has_multivalued_lookups
+from refinery.columnar import ColumnarBackend
+from refinery.memory import MemoryBackend, values_of
+from refinery.optimizer import optimize_q, trim_related_keys
+from refinery.paginator import supports_window_functions
+from refinery.snapshot import Snapshot
+from refinery.timeout import statement_timeout, QueryTimeout
 from refinery.filters import Filter, CharFilter, BooleanFilter, \
     ChoiceFilter, DateFilter, DateTimeFilter, TimeFilter, ModelChoiceFilter, \
-    ModelMultipleChoiceFilter, NumberFilter
+    ModelMultipleChoiceFilter, NumberFilter, ModelChoiceMixin, get_param
 
 ORDER_BY_FIELD = 'o'
+TOTAL_COLUMN = 'refinery_total'
+LAZY_FILTERTOOLS = getattr(settings, 'REFINERY_LAZY_FILTERTOOLS', False)
+QUERY_TIMEOUT = getattr(settings, 'REFINERY_QUERY_TIMEOUT', None)
+# the default stays under the 999 parameters older versions of SQLite allow
+REFINE_CACHE_MAX_SIZE = getattr(settings, 'REFINERY_REFINE_CACHE_MAX_SIZE', 900)
+# stand-ins for querysets which are filtered without the database
+MEMORY_BACKENDS = (MemoryBackend, ColumnarBackend)
 
 
 def get_declared_filters(bases, attrs, with_base_filters=True):
@@ -67,6 +91,42 @@ def get_model_field(model, f):
     return rel
 
 
+def combine_q(qs):
+    q_base = Q()
+    for q in qs:
+        q_base &= q
+    return q_base
+
+
+def get_related_path(model, f):
+    """
+    return the longest leading part of the lookup path ``f`` that only follows
+    forward ``ForeignKey``/``OneToOneField`` relations (suitable for passing to
+    ``select_related``), or None if the path doesn't start with one
+    
+    """
+    parts = f.lstrip('-').split(LOOKUP_SEP)
+    opts = model._meta
+    related = []
+    for name in parts[:-1]:
+        try:
+            field, _, direct, m2m = opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            break
+        if not direct or m2m or getattr(field, 'rel', None) is None:
+            break
+        related.append(name)
+        opts = field.rel.to._meta
+    if related:
+        return LOOKUP_SEP.join(related)
+
+
+def is_empty_value(value):
+    if isinstance(value, (list, tuple)):
+        return all(is_empty_value(v) for v in value)
+    return value in EMPTY_VALUES
+
+
 def filters_for_model(model, fields=None, exclude=None, filter_for_field=None):
     field_dict = SortedDict()
     opts = model._meta
@@ -97,6 +157,56 @@ class FilterToolOptions(object):
         self.exclude = getattr(options, 'exclude', None)
         self.order_by = getattr(options, 'order_by', False)
         self.form = getattr(options, 'form', forms.Form)
+        self.only = getattr(options, 'only', None)
+        self.defer = getattr(options, 'defer', None)
+        self.select_related = getattr(options, 'select_related', None)
+        self.prefetch_related = getattr(options, 'prefetch_related', None)
+        self.form_cache_timeout = getattr(options, 'form_cache_timeout', None)
+        self.trusted_pks = getattr(options, 'trusted_pks', False)
+        self.lazy = getattr(options, 'lazy', LAZY_FILTERTOOLS)
+        self.max_cost = getattr(options, 'max_cost', None)
+        self.max_joins = getattr(options, 'max_joins', None)
+        self.cost_exceeded = getattr(options, 'cost_exceeded', 'reject')
+        self.timeout = getattr(options, 'timeout', QUERY_TIMEOUT)
+        self.count_limit = getattr(options, 'count_limit', None)
+        self.aggregates = getattr(options, 'aggregates', None)
+        self.refine_cache_timeout = getattr(options, 'refine_cache_timeout', None)
+        self.refine_cache_max_size = getattr(options, 'refine_cache_max_size',
+            REFINE_CACHE_MAX_SIZE)
+
+
+def get_base_filters(new_class, declared_filters):
+    opts = new_class._meta
+    if opts.model:
+        filters = filters_for_model(opts.model, opts.fields, opts.exclude, new_class.filter_for_field)
+        filters.update(declared_filters)
+    else:
+        filters = declared_filters
+    
+    if None in filters.values():
+        raise TypeError("Meta.fields contains a field that isn't defined "
+            "on this FilterTool")
+    return filters
+
+
+class LazyBaseFilters(object):
+    """
+    Stands in for the ``base_filters`` of a FilterTool class with
+    ``Meta.lazy`` set, resolving them from the model the first time they are
+    needed (normally when the class is first instantiated) and replacing
+    itself with the result.  A configuration error is raised on every access
+    until it is fixed.
+    
+    """
+    def __init__(self, filtertool_class, declared_filters):
+        self.filtertool_class = filtertool_class
+        self.declared_filters = declared_filters
+    
+    def __get__(self, instance, owner):
+        filters = get_base_filters(self.filtertool_class, self.declared_filters)
+        setattr(self.filtertool_class, 'base_filters', filters)
+        register_filtertool(self.filtertool_class)
+        return filters
 
 
 class FilterToolMetaclass(type):
@@ -113,18 +223,13 @@ class FilterToolMetaclass(type):
             return new_class
         
         opts = new_class._meta = FilterToolOptions(getattr(new_class, 'Meta', None))
-        if opts.model:
-            filters = filters_for_model(opts.model, opts.fields, opts.exclude, new_class.filter_for_field)
-            filters.update(declared_filters)
-        else:
-            filters = declared_filters
-        
-        if None in filters.values():
-            raise TypeError("Meta.fields contains a field that isn't defined "
-                "on this FilterTool")
-        
         new_class.declared_filters = declared_filters
-        new_class.base_filters = filters
+        registry.register(new_class)
+        if opts.lazy:
+            new_class.base_filters = LazyBaseFilters(new_class, declared_filters)
+        else:
+            new_class.base_filters = get_base_filters(new_class, declared_filters)
+            register_filtertool(new_class)
         return new_class
 
 
@@ -216,27 +321,47 @@ if hasattr(models, "XMLField"):
 
 class BaseFilterTool(object):
     filter_overrides = {}
+    use_form = True
+    over_budget = False
+    timed_out = False
+    count_truncated = False
     
-    def __init__(self, data=None, queryset=None, prefix=None):
+    def __init__(self, data=None, queryset=None, prefix=None, timeout=None):
         self.is_bound = data is not None
         self.data = data or {}
         if queryset is None:
             # TODO: what if self._meta.model is None???
             queryset = self._meta.model._default_manager.all()
+        elif isinstance(queryset, (list, tuple)):
+            queryset = MemoryBackend(queryset, model=self._meta.model)
         self.queryset = queryset
         self.form_prefix = prefix
+        self.dropped_filters = []
+        if timeout is None:
+            timeout = self._meta.timeout
+        self.timeout = timeout
         
         self.filters = deepcopy(self.base_filters)
         # propagate the model being used through the filters
         for filter_ in self.filters.values():
             filter_.model = self._meta.model
+            if self._meta.trusted_pks and isinstance(filter_, ModelChoiceMixin):
+                filter_.trusted = True
+    
+    @property
+    def model(self):
+        # generic views name the context variable of an object list after
+        # its model
+        return getattr(self.queryset, 'model', None) or self._meta.model
     
     def __iter__(self):
-        for obj in self.qs:
-            yield obj
+        # fetching the rows fills the result cache of qs, so a template
+        # which goes on to iterate qs doesn't run the query again
+        return iter(self.run_with_timeout(lambda: list(self.qs), []))
     
     def __len__(self):
-        return self.qs.count()
+        # list() and templates take the length before iterating
+        return self.run_with_timeout(self._count, 0)
     
     def __getitem__(self, ndx):
         if isinstance(ndx, slice):
@@ -244,48 +369,532 @@ class BaseFilterTool(object):
         else:
             return getattr(self, ndx)
     
+    @classmethod
+    def from_params(cls, params, queryset=None, prefix=None, timeout=None):
+        """
+        create a FilterTool which compiles ``params`` (a dictionary or
+        ``QueryDict`` using the same parameter names as the form) straight to
+        a Q object with each filter's coercer, without building a form
+        
+        """
+        filtertool = cls(params, queryset=queryset, prefix=prefix, timeout=timeout)
+        filtertool.use_form = False
+        return filtertool
+    
+    def add_prefix(self, name):
+        if self.form_prefix:
+            return '%s-%s' % (self.form_prefix, name)
+        return name
+    
+    def compile_params(self):
+        """
+        return a (Q, errors) tuple for ``self.data``, where errors maps the
+        names of filters with invalid parameters to lists of messages
+        
+        """
+        results, errors = self._parse_params()
+        return combine_q(results.values()), errors
+    
+    def _parse_params(self):
+        if not hasattr(self, '_parsed_params'):
+            results = SortedDict()
+            errors = {}
+            for name, filter_ in self.filters.iteritems():
+                try:
+                    val = filter_.parse(self.data, self.add_prefix(name))
+                except forms.ValidationError, e:
+                    errors[name] = e.messages
+                    continue
+                if val or val is False or val is 0:
+                    result = filter_.filter(val)
+                    if result:
+                        results[name] = result
+            self._parsed_params = (results, errors)
+        return self._parsed_params
+    
+    @property
+    def errors(self):
+        if self.use_form:
+            return self.form.errors
+        return self._parse_params()[1]
+    
+    def get_filter_results(self):
+        """
+        return a SortedDict mapping the name of every filter that has a valid
+        value to the Q object it filters with
+        
+        """
+        if not self.use_form:
+            return self._parse_params()[0]
+        if hasattr(self, '_filter_results'):
+            return self._filter_results
+        results = SortedDict()
+        for name, filter_, data in self.active_filters():
+            try:
+                val = self.form.fields[name].clean(data)
+                
+                if val or val is False or val is 0: # Stop passing it when there's val!
+                    # TODO: what if I want to check that the field is null?
+                    # TODO: - check that a date field has NO date
+                    # TODO: - check that a relationship doesn't exist (company w/out employees)
+                    # TODO: - check filter all users without bio field filled out...
+                    result = filter_.filter(val)
+                    if result:
+                        results[name] = result # Stop passing it the qs!!
+            except forms.ValidationError:
+                pass
+        self._filter_results = results
+        return results
+    
+    def get_filter_q(self):
+        """
+        combine the Q objects of every filter that has a valid value
+        
+        """
+        return combine_q(self.get_filter_results().values())
+    
+    def is_within_budget(self, q):
+        """
+        whether the cost and number of joins of ``q`` are within the limits
+        set by ``Meta.max_cost`` and ``Meta.max_joins``
+        
+        """
+        max_cost, max_joins = self._meta.max_cost, self._meta.max_joins
+        if max_cost is None and max_joins is None:
+            return True
+        cost, joins = query_cost(self.queryset.model, q)
+        return (max_cost is None or cost <= max_cost) and \
+            (max_joins is None or len(joins) <= max_joins)
+    
+    def build_q(self, results):
+        """
+        combine and simplify the Q objects of the given filter results,
+        enforcing the query cost budget.  Returns None if the query can't
+        match anything or is rejected for being over budget.
+        
+        """
+        model = self.queryset.model
+        q_base = optimize_q(trim_related_keys(combine_q(results.values()), model))
+        if q_base is None or self.is_within_budget(q_base):
+            return q_base
+        if self._meta.cost_exceeded != 'degrade':
+            self.over_budget = True
+            return None
+        # drop the most expensive filters until the rest are within budget
+        results = results.copy()
+        costs = [(query_cost(model, trim_related_keys(q, model))[0], name)
+            for name, q in results.items()]
+        costs.sort(reverse=True)
+        for cost, name in costs:
+            del results[name]
+            self.dropped_filters.append(name)
+            q_base = optimize_q(trim_related_keys(combine_q(results.values()), model))
+            if q_base is None or self.is_within_budget(q_base):
+                return q_base
+        return q_base
+    
+    def get_order_by(self):
+        """
+        return the valid ordering requested by the user, if any
+        
+        """
+        if not self._meta.order_by:
+            return None
+        if not self.use_form:
+            value = get_param(self.data, self.add_prefix(ORDER_BY_FIELD))
+            if value and self.ordering_field.valid_value(value):
+                return value
+            return None
+        try:
+            return self.form.fields[ORDER_BY_FIELD].clean(self.form[ORDER_BY_FIELD].data)
+        except forms.ValidationError:
+            return None
+    
     @property
     def qs(self):
         if not hasattr(self, '_qs'):
-            q_base = Q()
+            if isinstance(self.queryset, MEMORY_BACKENDS):
+                return self._memory_qs()
             qs = self.queryset.all()
-            for name, filter_ in self.filters.iteritems():
-                try:
-                    if self.is_bound:
-                        data = self.form[name].data
-                    else:
-                        data = self.form.initial.get(name, self.form[name].field.initial)
-                    
-                    val = self.form.fields[name].clean(data)
-                    
-                    if val or val is False or val is 0: # Stop passing it when there's val!
-                        # TODO: what if I want to check that the field is null?
-                        # TODO: - check that a date field has NO date
-                        # TODO: - check that a relationship doesn't exist (company w/out employees)
-                        # TODO: - check filter all users without bio field filled out...
-                        result = filter_.filter(val)
-                        if result:
-                            q_base &= result # Stop passing it the qs!!
-                except forms.ValidationError:
-                    pass
-            self._qs = qs.filter(q_base).distinct()
+            results = self.get_filter_results()
+            # a cached search across a multi-valued relation can't be refined,
+            # as the new filters wouldn't share its joins
+            refine = self._meta.refine_cache_timeout is not None and results and \
+                not has_multivalued_lookups(self.queryset.model, self.get_filter_q())
+            pks = None
+            if refine:
+                # only the filters added since a cached search have to be
+                # applied, to the rows it matched
+                pks, rest = get_refinement(self, results)
+            else:
+                rest = results
+            q_base = self.build_q(rest)
+            if q_base is None:
+                # the filters contradict each other or are over budget, so
+                # don't bother the db
+                self._qs = qs.none()
+            else:
+                if pks is not None:
+                    q_base &= Q(pk__in=pks)
+                self._qs = qs.filter(q_base).distinct()
+                if refine and rest and not self.dropped_filters:
+                    pks = store_refinement(self, results, self._qs,
+                        self._meta.refine_cache_timeout, self._meta.refine_cache_max_size)
+                    if pks is not None:
+                        self._qs = qs.filter(pk__in=pks)
             
-            if self._meta.order_by:
-                try:
-                    value = self.form.fields[ORDER_BY_FIELD].clean(self.form[ORDER_BY_FIELD].data)
-                    if value:
-                        self._qs = self._qs.order_by(value)
-                except forms.ValidationError:
-                    pass
+            select_related = self._meta.select_related
+            paths = list(self._meta.only or ())
+            value = self.get_order_by()
+            if value:
+                self._qs = self._qs.order_by(value)
+                paths.append(value)
+            # ordering on a related field already joins the related table,
+            # and related columns loaded with Meta.only are displayed from
+            # it, so fetch its columns in the same query
+            if select_related is not True and not qs.query.select_related:
+                for path in paths:
+                    related = get_related_path(self.queryset.model, path)
+                    if related and related not in (select_related or ()):
+                        select_related = list(select_related or ()) + [related]
+            
+            if select_related is True:
+                self._qs = self._qs.select_related()
+            elif select_related:
+                self._qs = self._qs.select_related(*select_related)
+            if self._meta.prefetch_related:
+                self._qs = self._qs.prefetch_related(*self._meta.prefetch_related)
+            
+            if self._meta.only:
+                self._qs = self._qs.only(*self._meta.only)
+            if self._meta.defer:
+                self._qs = self._qs.defer(*self._meta.defer)
         
         return self._qs
     
+    def _memory_qs(self):
+        # the Q objects are evaluated in python, so none of the database
+        # specific rewriting and loading options apply
+        q_base = optimize_q(self.get_filter_q())
+        if q_base is None:
+            self._qs = self.queryset.none()
+        else:
+            self._qs = self.queryset.filter(q_base)
+        value = self.get_order_by()
+        if value:
+            self._qs = self._qs.order_by(value)
+        return self._qs
+    
+    def run_with_timeout(self, func, default=None):
+        """
+        call ``func`` with every statement it runs limited to ``self.timeout``
+        seconds, returning ``default`` and setting ``self.timed_out`` if one
+        of them takes longer
+        
+        """
+        if self.timeout is None or isinstance(self.queryset, MEMORY_BACKENDS):
+            return func()
+        try:
+            with statement_timeout(self.timeout, using=self.queryset.db):
+                return func()
+        except QueryTimeout:
+            self.timed_out = True
+            return default
+    
+    def count(self):
+        """
+        return the number of matching rows, or None if counting them timed
+        out.  With ``Meta.count_limit`` at most that many rows are counted,
+        and ``self.count_truncated`` is set if there are more.
+        
+        """
+        limit = self._meta.count_limit
+        if limit is None:
+            return self.run_with_timeout(self._count)
+        count = self.run_with_timeout(self.qs[:limit + 1].count)
+        if count > limit:
+            self.count_truncated = True
+            return limit
+        return count
+    
+    def _count(self):
+        if self._meta.aggregates and not isinstance(self.queryset, MEMORY_BACKENDS):
+            # count along with the aggregates the page will show anyway
+            return self.aggregate()['count']
+        if 'count' in getattr(self, '_aggregates', {}):
+            return self._aggregates['count']
+        return self.qs.count()
+    
+    def aggregate(self, *args, **kwargs):
+        """
+        return a dictionary of the given aggregates (as for
+        ``QuerySet.aggregate``), those in ``Meta.aggregates`` and the number
+        of matching rows under ``count``, computed over the matching rows in
+        one query.  The values are cached by name, so later calls only query
+        for aggregates they haven't seen.
+        
+        """
+        if isinstance(self.queryset, MEMORY_BACKENDS):
+            raise NotImplementedError("Aggregates can't be computed over rows "
+                "filtered in memory")
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        aggregates = dict(self._meta.aggregates or {})
+        aggregates.update(kwargs)
+        aggregates['count'] = Count('pk', distinct=True)
+        if not hasattr(self, '_aggregates'):
+            self._aggregates = {}
+        missing = dict((name, aggregate) for name, aggregate in aggregates.items()
+            if name not in self._aggregates)
+        if missing and isinstance(self.qs, EmptyQuerySet):
+            # the filters can't match anything, and EmptyQuerySet gives None
+            # for every aggregate, counts included
+            self._aggregates.update((name, None) for name in missing)
+            if 'count' in missing:
+                self._aggregates['count'] = 0
+        elif missing:
+            self._aggregates.update(self.qs.aggregate(**missing))
+        return dict((name, self._aggregates[name]) for name in aggregates)
+    
+    def fetch(self, start=None, stop=None):
+        """
+        return a list of the matching rows between ``start`` and ``stop``, or
+        an empty list if fetching them timed out
+        
+        """
+        return self.run_with_timeout(lambda: list(self.qs[start:stop]), [])
+    
+    def fetch_with_count(self, start, stop):
+        """
+        return a list of the matching rows between ``start`` and ``stop`` and
+        the total number of matching rows, or no rows and a count of 0 if
+        fetching them timed out.  Where the database supports window
+        functions the total is selected with the rows, so a second query is
+        only needed when there are no rows past ``start``.
+        
+        """
+        return self.run_with_timeout(lambda: self._fetch_with_count(start, stop), ([], 0))
+    
+    def _fetch_with_count(self, start, stop):
+        qs = self.qs
+        if not self.can_count_in_window():
+            return list(qs[start:stop]), qs.count()
+        rows = list(qs.extra(select={TOTAL_COLUMN: 'COUNT(*) OVER ()'})[start:stop])
+        if rows:
+            return rows, getattr(rows[0], TOTAL_COLUMN)
+        if not start:
+            return rows, 0
+        return rows, qs.count()
+    
+    def can_count_in_window(self):
+        if isinstance(self.queryset, MEMORY_BACKENDS) or \
+                not supports_window_functions(self.queryset.db):
+            return False
+        # the window is counted before DISTINCT removes the rows repeated by
+        # joins to many related rows, so it would count those rows too
+        if len(self.queryset.query.tables) > 1:
+            return False
+        model = self.queryset.model
+        order_by = self.get_order_by()
+        if order_by and is_multivalued(model, order_by.lstrip('-')):
+            return False
+        return not has_multivalued_lookups(model, self.get_filter_q())
+    
+    @classmethod
+    def batch_counts(cls, param_sets, queryset=None):
+        """
+        return the number of rows matching each of the parameter sets
+        ``param_sets`` (as for ``from_params()``), counted in one query
+        
+        """
+        return batch_counts(cls, param_sets, queryset)
+    
+    @classmethod
+    def batch_pks(cls, param_sets, limit=100, queryset=None):
+        """
+        return the primary keys of the first ``limit`` rows matching each of
+        the parameter sets ``param_sets``, selected in one query
+        
+        """
+        return batch_pks(cls, param_sets, limit, queryset)
+    
+    def snapshot(self, timeout=None, max_size=None):
+        """
+        store the ordered primary keys of the matching rows for ``timeout``
+        seconds (``REFINERY_SNAPSHOT_TIMEOUT`` by default) and return the
+        ``Snapshot``, whose ``cursor`` retrieves it with ``get_snapshot()``,
+        or None if more than ``max_size`` rows (``REFINERY_SNAPSHOT_MAX_SIZE``
+        by default) match
+        
+        """
+        return Snapshot.create(self, timeout, max_size)
+    
+    @classmethod
+    def get_snapshot(cls, cursor, queryset=None):
+        """
+        return the snapshot with the id ``cursor``, or None if it has expired
+        
+        """
+        return Snapshot.get(cls, cursor, queryset)
+    
+    def facet_counts(self, index):
+        """
+        return the number of matching rows for each value of each filter in
+        the ``refinery.bitmap.BitmapIndex`` ``index``, counting each filter's
+        values among the rows matched by the other filters.  The filters
+        which aren't indexed query the database under ``self.timeout``, and
+        no facets are returned if that times out.
+        
+        """
+        return self.run_with_timeout(lambda: index.facet_counts(self), {})
+    
+    def active_filters(self):
+        """
+        yield a (name, filter, data) tuple for each filter which has input,
+        either in the bound data or as an initial value.  Filters whose
+        widgets find nothing in the data are skipped without building a
+        BoundField or cleaning their value.
+        
+        """
+        form = self.form
+        if self.is_bound:
+            # widgets such as MultiWidget read their values from
+            # "<name>_<index>" keys, so index the data by those base names too
+            submitted = set()
+            for key in form.data:
+                submitted.add(key)
+                base, sep, index = key.rpartition('_')
+                if sep and index.isdigit():
+                    submitted.add(base)
+        for name, filter_ in self.filters.iteritems():
+            field = form.fields[name]
+            if self.is_bound:
+                if form.add_prefix(name) not in submitted and \
+                        self._is_empty_when_missing(name):
+                    continue
+                data = form[name].data
+            else:
+                data = form.initial.get(name, field.initial)
+                if is_empty_value(data) and self._is_empty_when_missing(name):
+                    continue
+            yield name, filter_, data
+    
+    def _is_empty_when_missing(self, name):
+        # most widgets return None (or a list of Nones) for missing data, which
+        # never results in a filter being applied; others, such as
+        # CheckboxInput, return a value which still has to be cleaned
+        if not hasattr(self, '_empty_when_missing'):
+            self._empty_when_missing = {}
+        if name not in self._empty_when_missing:
+            html_name = self.form.add_prefix(name)
+            widget = self.form.fields[name].widget
+            self._empty_when_missing[name] = is_empty_value(
+                widget.value_from_datadict({}, {}, html_name))
+        return self._empty_when_missing[name]
+    
+    def iterator(self, chunk_size=None):
+        """
+        iterate over the filtered results without filling the result cache of
+        ``qs``.  When ``chunk_size`` is given the results are fetched in
+        chunks of that many rows, keyed on the primary key, so that memory use
+        stays bounded regardless of the number of matching rows (the results
+        are then returned in primary key order)
+        
+        """
+        if not chunk_size or isinstance(self.queryset, MEMORY_BACKENDS):
+            # rows in memory take no more memory for being iterated at once
+            for obj in self.qs.iterator():
+                yield obj
+            return
+        qs = self.qs.order_by('pk')
+        chunk = list(qs[:chunk_size])
+        while chunk:
+            for obj in chunk:
+                yield obj
+            if len(chunk) < chunk_size:
+                break
+            chunk = list(qs.filter(pk__gt=chunk[-1].pk)[:chunk_size])
+    
+    def values(self, *fields):
+        """
+        return the filtered and ordered results as dictionaries rather than
+        model instances
+        
+        """
+        if isinstance(self.queryset, MEMORY_BACKENDS):
+            fields = fields or self._memory_fields()
+            return [dict(zip(fields, row)) for row in values_of(self.qs, fields)]
+        return self.qs.values(*fields)
+    
+    def values_list(self, *fields, **kwargs):
+        """
+        return the filtered and ordered results as tuples (or single values
+        when ``flat=True``) rather than model instances
+        
+        """
+        if isinstance(self.queryset, MEMORY_BACKENDS):
+            flat = kwargs.pop('flat', False)
+            if kwargs:
+                raise TypeError('Unexpected keyword arguments to values_list: %s'
+                    % (kwargs.keys(),))
+            if flat and len(fields) > 1:
+                raise TypeError("'flat' is not valid when values_list is called "
+                    "with more than one field.")
+            rows = values_of(self.qs, fields or self._memory_fields())
+            if flat:
+                return [row[0] for row in rows]
+            return rows
+        return self.qs.values_list(*fields, **kwargs)
+    
+    def _memory_fields(self):
+        model = getattr(self.queryset, 'model', None) or self._meta.model
+        return [f.attname for f in model._meta.fields]
+    
+    def only(self, *fields):
+        """
+        return the filtered and ordered results, loading only the given fields
+        (rows filtered in memory are already loaded, and returned as they are)
+        
+        """
+        if isinstance(self.queryset, MEMORY_BACKENDS):
+            return self.qs
+        return self.qs.only(*fields)
+    
+    def defer(self, *fields):
+        """
+        return the filtered and ordered results, deferring the given fields
+        
+        """
+        if isinstance(self.queryset, MEMORY_BACKENDS):
+            return self.qs
+        return self.qs.defer(*fields)
+    
     @property
     def form(self):
         if not hasattr(self, '_form'):
             self._form = self.get_form()
         return self._form
     
+    def render_form(self, method='as_table'):
+        """
+        render the form using the given form method, caching the resulting
+        HTML when ``Meta.form_cache_timeout`` is set
+        
+        """
+        timeout = self._meta.form_cache_timeout
+        if timeout is None:
+            return getattr(self.form, method)()
+        key = form_cache_key(self, method)
+        html = cache.get(key)
+        if html is None:
+            html = getattr(self.form, method)()
+            cache.set(key, html, timeout)
+        return mark_safe(html)
+    
+    @property
+    def rendered_form(self):
+        return self.render_form()
+    
     def get_form(self):
         """
         create form instance based on defined filters
@@ -300,16 +909,29 @@ class BaseFilterTool(object):
             form = Form(prefix=self.form_prefix)
         return form
     
+    @classmethod
+    def get_ordering_choices(cls):
+        """
+        return the choices for the ordering field given by ``Meta.order_by``,
+        computed once per class, or None when they are the instance's filters
+        
+        """
+        if not isinstance(cls._meta.order_by, (list, tuple)):
+            return None
+        if '_ordering_choices' not in cls.__dict__:
+            # choices = [(f, capfirst(f)) for f in cls._meta.order_by]
+            if isinstance(cls._meta.order_by[0], (list, tuple)):
+                choices = [(f[0], f[1]) for f in cls._meta.order_by]
+            else:
+                choices = [(f, capfirst(f)) for f in cls._meta.order_by]
+            cls._ordering_choices = choices
+        return cls._ordering_choices
+    
     def get_ordering_field(self):
         if self._meta.order_by:
-            if isinstance(self._meta.order_by, (list, tuple)):
-                # choices = [(f, capfirst(f)) for f in self._meta.order_by]
-                if isinstance(self._meta.order_by[0], (list, tuple)):
-                    choices = [(f[0], f[1]) for f in self._meta.order_by]
-                else:
-                    choices = [(f, capfirst(f)) for f in self._meta.order_by]
-            else:
-                # choices = [(f, capfirst(f)) for f in self.filters]
+            choices = self.get_ordering_choices()
+            if choices is None:
+                # __init__ may have added, removed or relabelled filters
                 choices = [(f, fltr.label) for f, fltr in self.filters.items()]
             return forms.ChoiceField(label="Ordering", required=False, choices=choices)
     
@@ -319,6 +941,23 @@ class BaseFilterTool(object):
             self._ordering_field = self.get_ordering_field()
         return self._ordering_field
     
+    @classmethod
+    def precompile(cls):
+        """
+        do the per-class work that doesn't depend on a request or on the
+        database up front: resolve the filters from the model (even when
+        ``Meta.lazy`` is set), connect the cache invalidation signals, and
+        compute the lookup type and ordering choices.  Instances copy the
+        results from the class.
+        
+        """
+        register_filtertool(cls)
+        for filter_ in cls.base_filters.values():
+            if filter_.has_lookup_choices:
+                filter_.get_lookup_choices()
+        if cls._meta.order_by:
+            cls.get_ordering_choices()
+    
     @classmethod
     def filter_for_field(cls, f, name, lookup_type=None):
         filter_for_field = dict(FILTER_FOR_DBFIELD_DEFAULTS, **cls.filter_overrides)
@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from refinery import registry
+
+
+class Command(NoArgsCommand):
+    help = ("Imports the filtertools module of every installed app and "
+        "precompiles every FilterTool class, reporting configuration errors.")
+
+    def handle_noargs(self, **options):
+        classes = registry.precompile()
+        if int(options.get('verbosity', 1)) > 1:
+            for filtertool_class in classes:
+                self.stdout.write('%s.%s\n' % (filtertool_class.__module__,
+                    filtertool_class.__name__))
+        self.stdout.write('Precompiled %d FilterTool classes.\n' % len(classes))
@@ -0,0 +1,458 @@
+# Filtering of in-memory data with the Q objects built by FilterTool filters.
+# Each Q object is compiled to a python predicate, and hash or sorted indexes
+# on the backend narrow down the items the predicate has to be checked on.
+import re
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+
+from django.db import models
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:
+    # Django < 1.5
+    from django.db.models.sql.constants import LOOKUP_SEP
+
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+
+from refinery.optimizer import split_lookup
+
+HASH_LOOKUPS = ('exact', 'in')
+SORTED_LOOKUPS = ('exact', 'gt', 'gte', 'lt', 'lte', 'range')
+
+
+def plain(value):
+    """
+    model instances compare by primary key, so that a lookup on a related
+    object also matches items holding only its key
+
+    """
+    if isinstance(value, models.Model):
+        return value.pk
+    return value
+
+
+def lower(value):
+    if value is None:
+        return None
+    return unicode(value).lower()
+
+
+def key_attname(obj, name):
+    """
+    a lookup on a foreign key only needs the key, which saves fetching the
+    related object
+
+    """
+    try:
+        field = obj._meta.get_field(name)
+    except FieldDoesNotExist:
+        return name
+    rel = getattr(field, 'rel', None)
+    if rel is None or isinstance(field, models.ManyToManyField) or \
+            rel.field_name != rel.to._meta.pk.name:
+        return name
+    return field.attname
+
+
+def get_values(item, path):
+    """
+    return the values found at ``path`` (a ``__`` separated sequence of
+    attribute names or dictionary keys) of ``item``, following managers and
+    lists into every related item they hold
+
+    """
+    values = [item]
+    names = path.split(LOOKUP_SEP)
+    for ndx, name in enumerate(names):
+        last = ndx == len(names) - 1
+        found = []
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, dict):
+                if name not in value and last:
+                    # values() gives foreign keys by their attname
+                    value = value.get('%s_id' % name)
+                else:
+                    value = value.get(name)
+            elif last and isinstance(value, models.Model):
+                value = getattr(value, key_attname(value, name), None)
+            else:
+                value = getattr(value, name, None)
+            if isinstance(value, models.Manager):
+                found.extend(value.all())
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                found.extend(value)
+            else:
+                found.append(value)
+        values = found
+    return values or [None]
+
+
+def to_type(arg, value):
+    """
+    return the string ``arg`` converted to the type of the item value
+    ``value`` it is compared with, as the database compares strings such as
+    'YYYY-MM-DD' to dates and python doesn't, or None if it can't be
+
+    """
+    if not isinstance(arg, basestring) or value is None or \
+            isinstance(value, (basestring, bool)):
+        return arg
+    try:
+        if isinstance(value, datetime):
+            parsed = parse_datetime(arg)
+            if parsed is None:
+                parsed = datetime.combine(parse_date(arg), time())
+            if parsed.tzinfo is None and value.tzinfo is not None:
+                parsed = parsed.replace(tzinfo=value.tzinfo)
+            if (parsed.tzinfo is None) != (value.tzinfo is None):
+                return None
+            return parsed
+        if isinstance(value, date):
+            return parse_date(arg)
+        if isinstance(value, time):
+            return parse_time(arg)
+        if isinstance(value, (int, long, float, Decimal)):
+            return Decimal(arg)
+    except (ValueError, TypeError, InvalidOperation):
+        return None
+    return arg
+
+
+def typed(arg):
+    """
+    return a function giving ``arg`` as the type of the item value it is
+    compared with (None if it can't be converted)
+
+    """
+    arg = plain(arg)
+    if not isinstance(arg, basestring):
+        return lambda v: arg
+    converted = {}
+    def convert(v):
+        if type(v) not in converted:
+            converted[type(v)] = to_type(arg, v)
+        return converted[type(v)]
+    return convert
+
+
+def make_in(arg):
+    arg = [plain(x) for x in arg]
+    try:
+        arg = frozenset(arg)
+    except TypeError:
+        pass
+    if [x for x in arg if isinstance(x, basestring)]:
+        return lambda v: v in arg or (v is not None and unicode(v) in arg)
+    return lambda v: v in arg
+
+
+def make_regex(arg, flags=0):
+    regex = re.compile(arg, flags)
+    return lambda v: v is not None and regex.search(unicode(v)) is not None
+
+
+def make_week_day(arg):
+    arg = int(arg)
+    # 1 is Sunday, like the database
+    return lambda v: v is not None and v.isoweekday() % 7 + 1 == arg
+
+
+def make_part(part):
+    def make(arg):
+        arg = int(arg)
+        return lambda v: v is not None and getattr(v, part) == arg
+    return make
+
+
+def make_compare(compare):
+    def make(arg):
+        convert = typed(arg)
+        def test(v):
+            if v is None:
+                return False
+            arg = convert(v)
+            return arg is not None and compare(v, arg)
+        return test
+    return make
+
+
+def make_text(compare):
+    def make(arg):
+        arg = lower(arg)
+        return lambda v: v is not None and compare(lower(v), arg)
+    return make
+
+
+def make_case_sensitive_text(compare):
+    def make(arg):
+        arg = unicode(arg)
+        return lambda v: v is not None and compare(unicode(v), arg)
+    return make
+
+
+def make_exact(arg):
+    arg = plain(arg)
+    if isinstance(arg, basestring):
+        # choice fields give strings for integer choices
+        return lambda v: v == arg or (v is not None and unicode(v) == arg)
+    return lambda v: v == arg
+
+
+def make_range(arg):
+    convert_low, convert_high = typed(arg[0]), typed(arg[1])
+    def test(v):
+        if v is None:
+            return False
+        low, high = convert_low(v), convert_high(v)
+        return low is not None and high is not None and low <= v <= high
+    return test
+
+
+def make_isnull(arg):
+    return lambda v: (v is None) == bool(arg)
+
+
+LOOKUPS = {
+    'exact': make_exact,
+    'iexact': make_text(lambda v, a: v == a),
+    'contains': make_case_sensitive_text(lambda v, a: a in v),
+    'icontains': make_text(lambda v, a: a in v),
+    'search': make_text(lambda v, a: a in v),
+    'in': make_in,
+    'gt': make_compare(lambda v, a: v > a),
+    'gte': make_compare(lambda v, a: v >= a),
+    'lt': make_compare(lambda v, a: v < a),
+    'lte': make_compare(lambda v, a: v <= a),
+    'startswith': make_case_sensitive_text(lambda v, a: v.startswith(a)),
+    'istartswith': make_text(lambda v, a: v.startswith(a)),
+    'endswith': make_case_sensitive_text(lambda v, a: v.endswith(a)),
+    'iendswith': make_text(lambda v, a: v.endswith(a)),
+    'range': make_range,
+    'year': make_part('year'),
+    'month': make_part('month'),
+    'day': make_part('day'),
+    'week_day': make_week_day,
+    'isnull': make_isnull,
+    'regex': make_regex,
+    'iregex': lambda arg: make_regex(arg, re.IGNORECASE),
+}
+
+
+def values_of(items, fields):
+    """
+    return a list of tuples of the values of ``fields`` (``__`` separated
+    paths) of each item, taking the first value of paths through lists and
+    managers
+
+    """
+    return [tuple(plain(get_values(item, path)[0]) for path in fields)
+        for item in items]
+
+
+def compile_lookup(key, value):
+    """
+    return a predicate which tells whether an item matches the single lookup
+    ``key=value``
+
+    """
+    path, lookup = split_lookup(key)
+    try:
+        make = LOOKUPS[lookup]
+    except KeyError:
+        raise NotImplementedError("The '%s' lookup can't be used in memory" % lookup)
+    test = make(value)
+    def predicate(item):
+        for v in get_values(item, path):
+            if test(plain(v)):
+                return True
+        return False
+    return predicate
+
+
+def compile_q(q):
+    """
+    return a predicate which tells whether an item matches ``q``
+
+    """
+    tests = []
+    for child in q.children:
+        if isinstance(child, Q):
+            tests.append(compile_q(child))
+        else:
+            tests.append(compile_lookup(*child))
+    if q.connector == Q.AND:
+        test = lambda item: all(t(item) for t in tests)
+    else:
+        test = lambda item: any(t(item) for t in tests)
+    if q.negated:
+        return lambda item: not test(item)
+    return test
+
+
+class MemoryBackend(object):
+    """
+    A list of objects or dictionaries which a FilterTool can filter in place
+    of a queryset.  ``hash_indexes`` and ``sorted_indexes`` name the fields
+    (``__`` separated paths) to index for ``exact``/``in`` and for range
+    lookups respectively; filtering on them only checks the items the indexes
+    return, rather than every item.
+
+    """
+    def __init__(self, items, model=None, hash_indexes=(), sorted_indexes=()):
+        self.items = list(items)
+        self.model = model
+        self.hash_indexes = {}
+        self.sorted_indexes = {}
+        self._string_keys = {}
+        for path in hash_indexes:
+            self.add_hash_index(path)
+        for path in sorted_indexes:
+            self.add_sorted_index(path)
+
+    def add_hash_index(self, path):
+        index = {}
+        for ndx, item in enumerate(self.items):
+            for value in get_values(item, path):
+                index.setdefault(plain(value), []).append(ndx)
+        self.hash_indexes[path] = index
+        self._string_keys.pop(path, None)
+
+    def string_keys(self, path):
+        """
+        map the keys of a hash index as strings to the keys, to look up the
+        strings choice fields give for integer choices
+
+        """
+        if path not in self._string_keys:
+            self._string_keys[path] = dict((unicode(k), k)
+                for k in self.hash_indexes[path] if k is not None)
+        return self._string_keys[path]
+
+    def add_sorted_index(self, path):
+        pairs = []
+        for ndx, item in enumerate(self.items):
+            for value in get_values(item, path):
+                if value is not None:
+                    pairs.append((plain(value), ndx))
+        pairs.sort()
+        self.sorted_indexes[path] = ([p[0] for p in pairs], [p[1] for p in pairs])
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, ndx):
+        if isinstance(ndx, slice):
+            return self._clone(self.items[ndx])
+        return self.items[ndx]
+
+    def _clone(self, items):
+        return MemoryBackend(items, model=self.model)
+
+    def all(self):
+        return self._clone(self.items)
+
+    def none(self):
+        return self._clone([])
+
+    def count(self):
+        return len(self.items)
+
+    def iterator(self):
+        return iter(self.items)
+
+    def filter(self, *args, **kwargs):
+        """
+        return the items matching the Q objects ``args`` and the lookups
+        ``kwargs``, in their original order
+
+        """
+        q = Q(*args, **kwargs)
+        predicate = compile_q(q)
+        positions = self.candidates(q)
+        if positions is None:
+            items = self.items
+        else:
+            items = [self.items[ndx] for ndx in sorted(positions)]
+        return self._clone([item for item in items if predicate(item)])
+
+    def order_by(self, *fields):
+        items = list(self.items)
+        for field in reversed(fields):
+            reverse = field.startswith('-')
+            path = field.lstrip('-')
+            items.sort(key=lambda item: plain(get_values(item, path)[0]), reverse=reverse)
+        return self._clone(items)
+
+    def candidates(self, q):
+        """
+        return a set of the positions of the items which may match ``q``
+        according to the indexes, or None if every item has to be checked
+
+        """
+        if q.negated:
+            return None
+        sets = []
+        for child in q.children:
+            if isinstance(child, Q):
+                positions = self.candidates(child)
+            else:
+                positions = self.index_lookup(*child)
+            if positions is None:
+                if q.connector == Q.OR:
+                    return None
+            else:
+                sets.append(positions)
+        if not sets:
+            return None
+        sets.sort(key=len)
+        if q.connector == Q.AND:
+            return sets[0].intersection(*sets[1:])
+        return sets[0].union(*sets[1:])
+
+    def index_lookup(self, key, value):
+        path, lookup = split_lookup(key)
+        if path in self.hash_indexes and lookup in HASH_LOOKUPS:
+            index = self.hash_indexes[path]
+            if lookup == 'exact':
+                value = [value]
+            positions = set()
+            try:
+                for v in value:
+                    v = plain(v)
+                    if isinstance(v, basestring) and v not in index:
+                        v = self.string_keys(path).get(v)
+                    positions.update(index.get(v, ()))
+            except TypeError:
+                # an unhashable value
+                return None
+            return positions
+        if path in self.sorted_indexes and lookup in SORTED_LOOKUPS:
+            keys, positions = self.sorted_indexes[path]
+            if lookup == 'range':
+                low, high = plain(value[0]), plain(value[1])
+            else:
+                low = high = plain(value)
+            if keys:
+                # strings are looked up as the type of the keys
+                low, high = to_type(low, keys[0]), to_type(high, keys[0])
+            if low is None or high is None:
+                return None
+            start, stop = 0, len(keys)
+            if lookup in ('exact', 'gte', 'range'):
+                start = bisect_left(keys, low)
+            elif lookup == 'gt':
+                start = bisect_right(keys, low)
+            if lookup in ('exact', 'lte', 'range'):
+                stop = bisect_right(keys, high)
+            elif lookup == 'lt':
+                stop = bisect_left(keys, high)
+            return set(positions[start:stop])
+        return None
@@ -0,0 +1,245 @@
+# Simplification of the combined Q object of a FilterTool before it is handed
+# to the ORM.  The pass is deliberately conservative: negated nodes are left
+# untouched (SQL's handling of NULL makes rewriting them unsafe), and bounds
+# are only merged when python compares their values the way the database does.
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.related import RelatedObject
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:
+    # Django < 1.5
+    from django.db.models.sql.constants import LOOKUP_SEP
+from django.db.models.sql.constants import QUERY_TERMS
+
+BOUND_LOOKUPS = ('exact', 'gt', 'gte', 'lt', 'lte', 'range')
+
+
+def split_lookup(key):
+    parts = key.split(LOOKUP_SEP)
+    if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+        return LOOKUP_SEP.join(parts[:-1]), parts[-1]
+    return key, 'exact'
+
+
+def trim_related_key(model, key):
+    """
+    rewrite a lookup which follows a ForeignKey only to compare the related
+    model's key (``author__id__in`` or ``author__pk``) to compare the local
+    column holding that key instead (``author__in`` or ``author``), which
+    never needs a join
+    
+    """
+    parts = key.split(LOOKUP_SEP)
+    if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+        lookup = parts[-1:]
+        parts = parts[:-1]
+    else:
+        lookup = []
+    if len(parts) < 2:
+        return key
+    opts = model._meta
+    try:
+        for name in parts[:-2]:
+            rel = opts.get_field_by_name(name)[0]
+            if isinstance(rel, RelatedObject):
+                opts = rel.opts
+            else:
+                opts = rel.rel.to._meta
+        field, _, direct, m2m = opts.get_field_by_name(parts[-2])
+    except (FieldDoesNotExist, AttributeError):
+        return key
+    if not direct or m2m or getattr(field, 'rel', None) is None:
+        return key
+    target = field.rel.to._meta
+    to_field = field.rel.field_name
+    if parts[-1] == to_field or (parts[-1] == 'pk' and to_field == target.pk.name):
+        return LOOKUP_SEP.join(parts[:-1] + lookup)
+    return key
+
+
+def trim_related_keys(q, model):
+    """
+    return a copy of ``q`` with every key rewritten by ``trim_related_key``
+    
+    """
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            children.append(trim_related_keys(child, model))
+        else:
+            children.append((trim_related_key(model, child[0]), child[1]))
+    return make_node(children, q.connector, q.negated)
+
+
+def comparable(a, b):
+    """
+    whether python and the database agree on how ``a`` and ``b`` compare
+
+    """
+    if type(a) is type(b):
+        return type(a) in (int, long, float, bool, Decimal, date, datetime, time)
+    return type(a) in (int, long) and type(b) in (int, long)
+
+
+def make_node(children, connector, negated=False):
+    node = Q()
+    node.children = children
+    node.connector = connector
+    node.negated = negated
+    return node
+
+
+def optimize_q(q):
+    """
+    return a simplified copy of ``q`` with empty nodes removed, nested nodes
+    flattened, duplicate predicates dropped and bounds on the same field
+    merged, or None if ``q`` can never match anything
+
+    """
+    if q.negated:
+        return q
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            child = optimize_q(child)
+            if child is None:
+                if q.connector == Q.AND:
+                    return None
+                continue
+            if not child.children:
+                continue
+            if not child.negated and (child.connector == q.connector or
+                    len(child.children) == 1):
+                new_children = child.children
+            else:
+                new_children = [child]
+        else:
+            new_children = [child]
+        for new_child in new_children:
+            if not contains(children, new_child):
+                children.append(new_child)
+    if q.connector == Q.AND:
+        children = merge_bounds(children)
+        if children is None:
+            return None
+    elif q.children and not children:
+        # every alternative was unsatisfiable
+        return None
+    if len(children) == 1 and isinstance(children[0], Q):
+        return children[0]
+    return make_node(children, q.connector)
+
+
+def contains(children, child):
+    for other in children:
+        if same(other, child):
+            return True
+    return False
+
+
+def same(a, b):
+    if isinstance(a, Q) or isinstance(b, Q):
+        if not (isinstance(a, Q) and isinstance(b, Q)):
+            return False
+        if a.connector != b.connector or a.negated != b.negated or \
+                len(a.children) != len(b.children):
+            return False
+        for x, y in zip(a.children, b.children):
+            if not same(x, y):
+                return False
+        return True
+    try:
+        return a[0] == b[0] and type(a[1]) is type(b[1]) and a[1] == b[1]
+    except Exception:
+        return False
+
+
+def merge_bounds(children):
+    """
+    merge the exact, gt(e), lt(e) and range predicates on each field of an
+    AND node into the tightest equivalent predicates, returning None if they
+    contradict each other
+
+    """
+    groups = {}
+    for ndx, child in enumerate(children):
+        if isinstance(child, Q):
+            continue
+        path, lookup = split_lookup(child[0])
+        if lookup not in BOUND_LOOKUPS:
+            continue
+        if lookup == 'range':
+            if not isinstance(child[1], (list, tuple)) or len(child[1]) != 2 or \
+                    None in child[1]:
+                continue
+            values = list(child[1])
+        else:
+            if child[1] is None:
+                continue
+            values = [child[1]]
+        groups.setdefault(path, []).append((ndx, lookup, values))
+
+    replaced = {}
+    for path, leaves in groups.items():
+        if len(leaves) < 2:
+            continue
+        first = leaves[0][2][0]
+        if not all(comparable(first, v) for ndx, lookup, values in leaves for v in values):
+            continue
+        lower = upper = None
+        try:
+            for ndx, lookup, values in leaves:
+                if lookup in ('exact', 'gt', 'gte', 'range'):
+                    lower = tighter(lower, (values[0], lookup != 'gt'), max)
+                if lookup in ('exact', 'lt', 'lte', 'range'):
+                    upper = tighter(upper, (values[-1], lookup != 'lt'), min)
+            if lower and upper:
+                if lower[0] > upper[0]:
+                    return None
+                if lower[0] == upper[0] and not (lower[1] and upper[1]):
+                    return None
+        except TypeError:
+            # e.g. naive and aware datetimes
+            continue
+        replaced[leaves[0][0]] = bounds_to_children(path, lower, upper)
+        for ndx, lookup, values in leaves[1:]:
+            replaced[ndx] = []
+
+    if not replaced:
+        return children
+    merged = []
+    for ndx, child in enumerate(children):
+        merged.extend(replaced.get(ndx, [child]))
+    return merged
+
+
+def tighter(current, bound, pick):
+    """
+    return the tighter of two (value, inclusive) bounds, where ``pick`` is max
+    for lower bounds and min for upper bounds
+
+    """
+    if current is None:
+        return bound
+    if current[0] == bound[0]:
+        return (current[0], current[1] and bound[1])
+    if pick(current[0], bound[0]) == current[0]:
+        return current
+    return bound
+
+
+def bounds_to_children(path, lower, upper):
+    if lower and upper and lower[1] and upper[1]:
+        if lower[0] == upper[0]:
+            return [('%s__exact' % path, lower[0])]
+        return [('%s__range' % path, (lower[0], upper[0]))]
+    children = []
+    if lower:
+        children.append(('%s__%s' % (path, lower[1] and 'gte' or 'gt'), lower[0]))
+    if upper:
+        children.append(('%s__%s' % (path, upper[1] and 'lte' or 'lt'), upper[0]))
+    return children
@@ -0,0 +1,77 @@
+import re
+
+from django.core.paginator import Paginator, Page, PageNotAnInteger, EmptyPage
+from django.db import connections, DEFAULT_DB_ALIAS
+
+_window_functions = {}
+
+
+def parse_mysql_version(info):
+    """
+    return whether the MySQL server info string ``info`` is MariaDB's, and
+    the (major, minor) version tuple.  MariaDB numbers its versions from 10,
+    past MySQL's 8, without having had window functions before 10.2.
+
+    """
+    mariadb = 'mariadb' in info.lower()
+    if mariadb and info.startswith('5.5.5-'):
+        # the prefix older replication clients expect
+        info = info[len('5.5.5-'):]
+    match = re.match(r'(\d+)\.(\d+)', info)
+    if match is None:
+        return mariadb, ()
+    return mariadb, tuple(int(n) for n in match.groups())
+
+
+def supports_window_functions(using=None):
+    """
+    whether the database ``using`` supports ``COUNT(*) OVER ()``
+
+    """
+    using = using or DEFAULT_DB_ALIAS
+    if using not in _window_functions:
+        connection = connections[using]
+        vendor = connection.vendor
+        if vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            supported = Database.sqlite_version_info >= (3, 25)
+        elif vendor == 'postgresql':
+            connection.cursor()
+            supported = connection.pg_version >= 80400
+        elif vendor == 'mysql':
+            connection.cursor()
+            mariadb, version = parse_mysql_version(connection.connection.get_server_info())
+            if mariadb:
+                supported = version >= (10, 2)
+            else:
+                supported = version >= (8, 0)
+        else:
+            supported = vendor == 'oracle'
+        _window_functions[using] = supported
+    return _window_functions[using]
+
+
+class FilterToolPaginator(Paginator):
+    """
+    A Paginator for a FilterTool which fetches the rows of a page together
+    with the total number of rows, in one query where the database supports
+    window functions
+
+    """
+    def page(self, number):
+        if self._count is not None:
+            return super(FilterToolPaginator, self).page(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        bottom = (number - 1) * self.per_page
+        rows, self._count = self.object_list.fetch_with_count(bottom,
+            bottom + self.per_page + self.orphans)
+        number = self.validate_number(number)
+        top = bottom + self.per_page
+        if top + self.orphans >= self._count:
+            top = self._count
+        return Page(rows[:top - bottom], number, self)
@@ -0,0 +1,182 @@
+# Reverse matching: rather than finding the rows matching a search, find the
+# saved searches matching a row.  Each search is compiled to a python
+# predicate over one instance, and an inverted index on one equality (or
+# choice) condition every match requires picks the few searches worth checking.
+from django.core.exceptions import ValidationError
+from django.db.models import Q, ManyToManyField
+from django.db.models.fields import FieldDoesNotExist
+
+from refinery.memory import compile_q, plain
+from refinery.optimizer import split_lookup
+
+
+class Percolator(object):
+    """
+    A set of saved searches of ``filtertool_class``, each given by a key and
+    its parameters (as for ``FilterTool.from_params()``), which tells which of
+    them a model instance matches without querying the database (unless the
+    searches filter across multi-valued relations).
+
+    """
+    def __init__(self, filtertool_class):
+        self.filtertool_class = filtertool_class
+        self.model = filtertool_class._meta.model
+        self.predicates = {}
+        # maps field attnames to {value: set of keys}
+        self.index = {}
+        self.indexed = {}
+        self.unindexed = set()
+
+    def __len__(self):
+        return len(self.predicates)
+
+    def __contains__(self, key):
+        return key in self.predicates
+
+    def get_field(self, path):
+        """
+        return the local, single-valued field at ``path``, or None
+
+        """
+        try:
+            field = self.model._meta.get_field(path)
+        except FieldDoesNotExist:
+            return None
+        if isinstance(field, ManyToManyField):
+            return None
+        return field
+
+    def to_python(self, field, value):
+        """
+        convert ``value`` to the type the instances hold in the field, as
+        choice filters give strings and related filters give objects
+
+        """
+        if field.rel is not None:
+            field = field.rel.get_related_field()
+        return field.to_python(plain(value))
+
+    def convert_q(self, q):
+        """
+        return a copy of ``q`` with the arguments of the lookups on local
+        fields converted by the fields, so that strings (the 'YYYY-MM-DD'
+        bounds of a DateRangeFilter, say) compare with the instances' values
+
+        """
+        converted = Q()
+        converted.connector = q.connector
+        converted.negated = q.negated
+        for child in q.children:
+            if isinstance(child, Q):
+                converted.children.append(self.convert_q(child))
+                continue
+            key, value = child
+            path, lookup = split_lookup(key)
+            field = self.get_field(path)
+            if field is not None and lookup in ('exact', 'gt', 'gte', 'lt', 'lte', 'range', 'in'):
+                try:
+                    if lookup in ('range', 'in'):
+                        value = [self.to_python(field, v) for v in value]
+                    elif value is not None:
+                        value = self.to_python(field, value)
+                except ValidationError:
+                    # the predicate decides
+                    pass
+            converted.children.append((key, value))
+        return converted
+
+    def index_terms(self, q):
+        """
+        return an (attname, values) tuple for the ``exact`` or ``in`` condition
+        on a local field with the fewest values which every row matching
+        ``q`` has to satisfy, or None if there isn't one
+
+        """
+        if q.negated or (q.connector != Q.AND and len(q.children) > 1):
+            return None
+        best = None
+        for child in q.children:
+            if isinstance(child, Q):
+                terms = self.index_terms(child)
+            else:
+                path, lookup = split_lookup(child[0])
+                field = self.get_field(path)
+                if field is None or lookup not in ('exact', 'in'):
+                    continue
+                if lookup == 'exact':
+                    values = [child[1]]
+                else:
+                    values = list(child[1])
+                try:
+                    values = set(self.to_python(field, v) for v in values)
+                except ValidationError:
+                    # the predicate decides
+                    continue
+                terms = (field.attname, values)
+            if terms is not None and (best is None or len(terms[1]) < len(best[1])):
+                best = terms
+        return best
+
+    def add(self, key, params):
+        """
+        save the search ``params`` under ``key``, replacing any search saved
+        under it before.  Raises NotImplementedError if the search uses a
+        lookup which can't be checked in python.
+
+        """
+        filtertool = self.filtertool_class.from_params(params)
+        q = filtertool.build_q(filtertool.get_filter_results())
+        if q is not None:
+            q = self.convert_q(q)
+        predicate = q is not None and compile_q(q) or None
+        self.remove(key)
+        if predicate is None:
+            # the search can't match anything
+            self.predicates[key] = None
+            return
+        self.predicates[key] = predicate
+        terms = self.index_terms(q)
+        if terms is None:
+            self.unindexed.add(key)
+            return
+        attname, values = terms
+        index = self.index.setdefault(attname, {})
+        for value in values:
+            index.setdefault(value, set()).add(key)
+        self.indexed[key] = terms
+
+    def remove(self, key):
+        if key not in self.predicates:
+            return
+        del self.predicates[key]
+        self.unindexed.discard(key)
+        terms = self.indexed.pop(key, None)
+        if terms is not None:
+            attname, values = terms
+            index = self.index[attname]
+            for value in values:
+                keys = index[value]
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+            if not index:
+                del self.index[attname]
+
+    def candidates(self, instance):
+        """
+        return the keys of the searches ``instance`` may match according to
+        the inverted index
+
+        """
+        keys = set(self.unindexed)
+        for attname, index in self.index.items():
+            keys.update(index.get(getattr(instance, attname, None), ()))
+        return keys
+
+    def percolate(self, instance):
+        """
+        return the set of the keys of the searches ``instance`` matches
+
+        """
+        predicates = self.predicates
+        return set(key for key in self.candidates(instance) if predicates[key](instance))
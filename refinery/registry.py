@@ -0,0 +1,60 @@
+import weakref
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+_filtertools = []
+
+
+def register(filtertool_class):
+    """
+    record a FilterTool class, which is done for every subclass as it is
+    defined.  Only weak references are kept, so classes defined on the fly
+    (by the generic views, for example) can still be garbage collected, and
+    each reference is dropped with its class.
+
+    """
+    _filtertools.append(weakref.ref(filtertool_class, _filtertools.remove))
+
+
+def get_filtertools():
+    """
+    return every FilterTool class defined so far which is still alive
+
+    """
+    classes = [ref() for ref in _filtertools]
+    return [filtertool_class for filtertool_class in classes if filtertool_class is not None]
+
+
+def autodiscover(module_name='filtertools'):
+    """
+    import the ``filtertools`` module of every installed app which has one,
+    so that the FilterTool classes it defines are registered
+
+    """
+    for app in settings.INSTALLED_APPS:
+        mod = import_module(app)
+        try:
+            import_module('%s.%s' % (app, module_name))
+        except ImportError:
+            # only bubble up the error if the app has the module
+            if module_has_submodule(mod, module_name):
+                raise
+
+
+def precompile(discover=True):
+    """
+    precompile every registered FilterTool class (after importing the
+    ``filtertools`` module of every installed app when ``discover`` is True)
+    and return them.  Call this before a preforking server forks its workers
+    (e.g. from a gunicorn ``on_starting`` hook or at the end of the WSGI
+    module when preloading) so the workers don't each repeat the work.
+
+    """
+    if discover:
+        autodiscover()
+    classes = get_filtertools()
+    for filtertool_class in classes:
+        filtertool_class.precompile()
+    return classes
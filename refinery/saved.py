@@ -0,0 +1,108 @@
+# Saved searches which are run over and over (for "new matches" alerts, say)
+# remember the highest value of an increasing column they have seen, so each
+# run only evaluates their filters against the rows added since the last one.
+from django.db.models import Q, Max
+from django.utils import simplejson as json
+
+from refinery.batch import compile_sets, select_pks
+
+
+class SavedSearch(object):
+    """
+    The parameters of a search (as for ``FilterTool.from_params()``) with a
+    high-water mark: the highest value of ``field`` (the primary key, or an
+    ever increasing column such as a creation timestamp) the search has been
+    run against.  A search without a watermark matches nothing on its first
+    run, which only sets the watermark.
+
+    """
+    def __init__(self, params, watermark=None, field='pk'):
+        if hasattr(params, 'lists'):
+            params = dict((name, values[0] if len(values) == 1 else values)
+                for name, values in params.lists())
+        self.params = params
+        self.watermark = watermark
+        self.field = field
+
+    def dumps(self):
+        """
+        return the search serialized as a JSON string
+
+        """
+        watermark = self.watermark
+        if hasattr(watermark, 'isoformat'):
+            # keeps the microseconds, which DjangoJSONEncoder drops
+            watermark = watermark.isoformat()
+        return json.dumps({
+            'params': self.params,
+            'watermark': watermark,
+            'field': self.field,
+        })
+
+    @classmethod
+    def loads(cls, data):
+        data = json.loads(data)
+        return cls(data['params'], data['watermark'], data['field'])
+
+    def get_watermark(self, model):
+        """
+        return the watermark as a value of the model's field, as JSON turns
+        dates and times into strings
+
+        """
+        if self.watermark is None:
+            return None
+        if self.field == 'pk':
+            field = model._meta.pk
+        else:
+            field = model._meta.get_field(self.field)
+        return field.to_python(self.watermark)
+
+
+def run_searches(filtertool_class, searches, queryset=None, limit=None):
+    """
+    return, for each of ``searches``, the primary keys of the rows (in
+    primary key order, at most ``limit`` of them) added since its last run
+    and matching it, and move its watermark past every row there is now, or
+    only past the last row returned when there may be more matches.
+    One query finds the new watermarks and one more the matches of every
+    search, each bounded by the range of rows it hasn't seen yet.  As the
+    matches come in primary key order, ``limit`` only works with primary key
+    watermarks.
+
+    """
+    if not searches:
+        return []
+    if queryset is None:
+        queryset = filtertool_class._meta.model._default_manager.all()
+    model = queryset.model
+    pk_fields = ('pk', model._meta.pk.name)
+    if limit is not None and [s for s in searches if s.field not in pk_fields]:
+        raise ValueError("A limit can only be used with primary key watermarks")
+    fields = sorted(set(search.field for search in searches))
+    highs = queryset.aggregate(**dict(('high_%d' % ndx, Max(field))
+        for ndx, field in enumerate(fields)))
+    highs = dict((field, highs['high_%d' % ndx]) for ndx, field in enumerate(fields))
+    compiled = compile_sets(filtertool_class, [s.params for s in searches], queryset)
+    conditions = []
+    for search, (filtertool, q) in zip(searches, compiled):
+        low = search.get_watermark(model)
+        high = highs[search.field]
+        if q is None or low is None or high is None or low >= high:
+            conditions.append(None)
+        else:
+            conditions.append(q & Q(**{
+                '%s__gt' % search.field: low,
+                '%s__lte' % search.field: high,
+            }))
+    results = select_pks(queryset, conditions, limit)
+    for search, pks in zip(searches, results):
+        low = search.get_watermark(model)
+        high = highs[search.field]
+        if limit is not None and len(pks) == limit:
+            # the matches past the limit are left for the next run
+            high = pks[-1]
+        # the watermark never goes back, even when the newest rows are deleted
+        if high is not None and (low is None or high > low):
+            search.watermark = high
+    return results
@@ -0,0 +1,87 @@
+from array import array
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+SNAPSHOT_PREFIX = 'refinery:snapshot'
+SNAPSHOT_TIMEOUT = getattr(settings, 'REFINERY_SNAPSHOT_TIMEOUT', 600)
+# 100000 integer keys take 800KB, under memcached's 1MB limit on a value
+SNAPSHOT_MAX_SIZE = getattr(settings, 'REFINERY_SNAPSHOT_MAX_SIZE', 100000)
+
+
+def filtertool_label(filtertool_class):
+    return '%s.%s' % (filtertool_class.__module__, filtertool_class.__name__)
+
+
+def snapshot_key(cursor):
+    return '%s:%s' % (SNAPSHOT_PREFIX, cursor)
+
+
+class Snapshot(object):
+    """
+    The ordered primary keys of the rows a FilterTool matched at one point in
+    time, cached under the id ``cursor``.  Pages of the snapshot hold the same
+    rows in the same order however the table changes, except that deleted
+    rows are left out, and only fetch the rows of the page by primary key.
+
+    """
+    def __init__(self, cursor, pks, queryset):
+        self.cursor = cursor
+        self.pks = pks
+        self.queryset = queryset
+
+    @classmethod
+    def create(cls, filtertool, timeout=None, max_size=None):
+        """
+        store the primary keys of the rows ``filtertool`` matches and return
+        the snapshot, or None if there are more than ``max_size`` of them, as
+        the cache may not hold that many
+
+        """
+        if max_size is None:
+            max_size = SNAPSHOT_MAX_SIZE
+        pks = list(filtertool.qs.values_list('pk', flat=True)[:max_size + 1])
+        if len(pks) > max_size:
+            return None
+        if [pk for pk in pks if not isinstance(pk, (int, long))]:
+            data = ('', pks)
+        else:
+            # an array of machine integers is a fraction of the size of a
+            # pickled list
+            data = ('l', array('l', pks).tostring())
+        cursor = uuid4().hex
+        if timeout is None:
+            timeout = SNAPSHOT_TIMEOUT
+        cache.set(snapshot_key(cursor),
+            (filtertool_label(filtertool.__class__),) + data, timeout)
+        return cls(cursor, pks, filtertool.queryset)
+
+    @classmethod
+    def get(cls, filtertool_class, cursor, queryset=None):
+        """
+        return the snapshot ``cursor`` of ``filtertool_class``, or None if it
+        has expired
+
+        """
+        data = cache.get(snapshot_key(cursor))
+        if data is None or data[0] != filtertool_label(filtertool_class):
+            return None
+        label, typecode, pks = data
+        if typecode:
+            pks = array(typecode, pks)
+        if queryset is None:
+            queryset = filtertool_class._meta.model._default_manager.all()
+        return cls(cursor, pks, queryset)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def page(self, start, stop):
+        """
+        return the rows of the snapshot from ``start`` to ``stop``
+
+        """
+        pks = list(self.pks[start:stop])
+        rows = self.queryset.in_bulk(pks)
+        return [rows[pk] for pk in pks if pk in rows]
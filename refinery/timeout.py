@@ -0,0 +1,75 @@
+import time
+
+from django.db import connections, transaction, DatabaseError, DEFAULT_DB_ALIAS
+
+# number of SQLite virtual machine instructions between two checks of the
+# deadline; lower values interrupt sooner at a small cost to every query
+SQLITE_PROGRESS_STEPS = 1000
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class statement_timeout(object):
+    """
+    context manager which limits the time each statement run inside it may
+    take to ``seconds``, raising QueryTimeout in place of the database error
+    of a statement which is cancelled.  The limit is enforced by the backend:
+    a progress handler on SQLite, ``statement_timeout`` on PostgreSQL and
+    ``max_execution_time`` on MySQL; other backends run the statements
+    without a limit.
+
+    """
+    def __init__(self, seconds, using=None):
+        self.seconds = seconds
+        self.connection = connections[using or DEFAULT_DB_ALIAS]
+        self.vendor = self.connection.vendor
+
+    def __enter__(self):
+        self.deadline = time.time() + self.seconds
+        self.restore = None
+        self.sid = None
+        cursor = self.connection.cursor()
+        if self.vendor == 'sqlite':
+            self.connection.connection.set_progress_handler(
+                self.interrupt, SQLITE_PROGRESS_STEPS)
+        elif self.vendor == 'postgresql':
+            # a cancelled statement aborts the transaction, so keep a
+            # savepoint to return to
+            self.sid = transaction.savepoint(using=self.connection.alias)
+            cursor.execute('SHOW statement_timeout')
+            self.restore = ('SET statement_timeout = %s', cursor.fetchone()[0])
+            cursor.execute('SET statement_timeout = %s', [self.milliseconds])
+        elif self.vendor == 'mysql':
+            try:
+                cursor.execute('SELECT @@max_execution_time')
+                self.restore = ('SET SESSION max_execution_time = %s', cursor.fetchone()[0])
+                cursor.execute('SET SESSION max_execution_time = %s', [self.milliseconds])
+            except DatabaseError:
+                # MySQL < 5.7.8 has no statement timeout
+                self.restore = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timed_out = exc_type is not None and issubclass(exc_type, DatabaseError) \
+            and time.time() >= self.deadline
+        if self.sid is not None:
+            if timed_out:
+                transaction.savepoint_rollback(self.sid, using=self.connection.alias)
+            else:
+                transaction.savepoint_commit(self.sid, using=self.connection.alias)
+        if self.vendor == 'sqlite':
+            self.connection.connection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+        elif self.restore is not None:
+            self.connection.cursor().execute(self.restore[0], [self.restore[1]])
+        if timed_out:
+            raise QueryTimeout(str(exc_value))
+        return False
+
+    @property
+    def milliseconds(self):
+        return max(1, int(self.seconds * 1000))
+
+    def interrupt(self):
+        return time.time() >= self.deadline
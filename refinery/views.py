@@ -5,7 +5,7 @@ from refinery.filtertool import FilterTool
 
 
 def object_filtered_list(request, model=None, queryset=None, template_name=None, extra_context=None,
-    context_processors=None, filter_class=None):
+    context_processors=None, filter_class=None, timeout=None):
     if model is None and filter_class is None:
         raise TypeError("object_filtered_list must be called with either model or filter_class")
     if model is None:
@@ -14,7 +14,7 @@ def object_filtered_list(request, model=None, queryset=None, template_name=None,
         meta = type('Meta', (object,), {'model': model})
         filter_class = type('%sFilterTool' % model._meta.object_name, (FilterTool,),
             {'Meta': meta})
-    filtertool = filter_class(request.GET or None, queryset=queryset)
+    filtertool = filter_class(request.GET or None, queryset=queryset, timeout=timeout)
 
     if not template_name:
         template_name = '%s/%s_filtered_list.html' % (model._meta.app_label, model._meta.object_name.lower())
@@ -35,8 +35,12 @@ from django.views.generic.list import MultipleObjectMixin
 from django.views.generic.list import MultipleObjectTemplateResponseMixin
 from django.utils.translation import ugettext_lazy as _
 
+from refinery.paginator import FilterToolPaginator
+
 class BaseFilteredListView(MultipleObjectMixin, View):
     filter_class = None
+    filter_timeout = None
+    paginator_class = FilterToolPaginator
 
     def get(self, request, *args, **kwargs):
         self.object_list = self.get_queryset()
@@ -67,8 +71,12 @@ class BaseFilteredListView(MultipleObjectMixin, View):
     def get_context_data(self, **kwargs):
         request = kwargs.pop('request')
         filter_class = self.get_filter_class()
-        filterset = filter_class(request.GET or None, self.get_queryset())
+        filterset = filter_class(request.GET or None, self.get_queryset(),
+                                 timeout=self.filter_timeout)
         kwargs['filter'] = filterset
+        # list (and paginate, fetching each page with its count) the
+        # filtered rows
+        kwargs['object_list'] = filterset
         return super(BaseFilteredListView, self).get_context_data(**kwargs)
 
 
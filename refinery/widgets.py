@@ -5,7 +5,7 @@ from django import forms
 from django.conf import settings
 from django.db.models.fields import BLANK_CHOICE_DASH
 from django.forms.widgets import flatatt
-from django.utils.encoding import force_unicode
+from django.utils.encoding import force_unicode, smart_str
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
@@ -38,6 +38,7 @@ class LinkWidget(forms.Widget):
 
     def render_options(self, choices, selected_choices, name):
         selected_choices = set(force_unicode(v) for v in selected_choices)
+        self._query_string_parts = None
         output = []
         for option_value, option_label in chain(self.choices, choices):
             if isinstance(option_label, (list, tuple)):
@@ -47,27 +48,59 @@ class LinkWidget(forms.Widget):
                 output.append(self.render_option(name, selected_choices, option_value, option_label))
         return u'\n'.join(output)
 
-    def render_option(self, name, selected_choices, option_value, option_label):
-        # option_value = force_unicode(option_value)
+    def query_string_parts(self, name):
+        """
+        Returns a tuple of the encoded query string parameters which come
+        before and after the ``name`` parameter, along with a function to
+        encode the ``name`` parameter itself.  This matches the output of
+        urlencoding a copy of ``self.data`` with ``name`` set, but is computed
+        only once per render rather than once per option.
+        
+        """
+        cached = getattr(self, '_query_string_parts', None)
+        if cached is not None and cached[0] == name:
+            return cached[1]
         data = self.data.copy()
+        data[name] = u''
+        if hasattr(data, 'urlencode'):
+            encoding = data.encoding
+            encode = lambda k, v: urlencode({smart_str(k, encoding): smart_str(v, encoding)})
+            items = [(k, v) for k, list_ in data.lists() for v in list_]
+        else:
+            encode = lambda k, v: urlencode({k: v})
+            items = data.items()
+        keys = [k for k, v in items]
+        position = keys.index(name)
+        before = [encode(k, v) for k, v in items[:position]]
+        after = [encode(k, v) for k, v in items[position + 1:]]
+        parts = (before, after, encode)
+        self._query_string_parts = (name, parts)
+        return parts
+
+    def render_option(self, name, selected_choices, option_value, option_label):
         if option_value is not None:
             option_value = force_unicode(option_value)
-            data[name] = option_value
+            before, after, encode = self.query_string_parts(name)
+            url = '&'.join(before + [encode(name, option_value)] + after)
+            # a copy of the data with this option set only equals the current
+            # data if the current value for the field is the option value
+            if hasattr(self.data, 'setlist'):
+                current = self.data.getlist(name) if name in self.data else None
+                selected = current == [option_value]
+            else:
+                selected = name in self.data and self.data[name] == option_value
         else:
+            data = self.data.copy()
             if data.get(name, None) is not None:
                 del data[name]
+            selected = data == self.data
+            try:
+                url = data.urlencode()
+            except AttributeError:
+                url = urlencode(data)
         if option_label == BLANK_CHOICE_DASH[0][1]:
             option_label = _("All")
-        # data = self.data.copy()
-        # data[name] = option_value
-        selected = data == self.data or option_value in selected_choices
-        # Make sure that data is utf-8 encoded before being passed to urlencode.
-        # import types
-        # data = dict([(k,v.encode('utf-8') if type(v) is types.UnicodeType else v) for (k,v) in data.items()])
-        try:
-            url = data.urlencode()
-        except AttributeError:
-            url = urlencode(data)
+        selected = selected or option_value in selected_choices
         return self.option_string() % {
              'attrs': selected and ' class="selected"' or '',
              'query_string': url,
@@ -1,9 +1,11 @@
 from __future__ import with_statement
 import os
 import datetime
+from decimal import Decimal
 from django.conf import settings
 from django.db.models import Q
 from django import forms
+from django.utils.unittest import SkipTest
 import refinery
 from refinery import FilterTool
 from refinery.widgets import LinkWidget
@@ -656,3 +658,1553 @@ class FinishingFilterToolUsageTest(FilterToolTestCase):
         self.assertHTMLEqual(unicode(f.form), form_html)
 
 
+
+
+class ValuesTest(FilterToolTestCase):
+    
+    def test_values(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+                order_by = ['username']
+        
+        f = F({'status': '0', 'o': 'username'})
+        self.assertEqual(list(f.values('username')),
+            [{'username': u'aaron'}, {'username': u'jacob'}])
+        self.assertEqual(list(f.values_list('username', flat=True)),
+            [u'aaron', u'jacob'])
+        self.assertEqual(list(f.values_list('pk', 'username')),
+            [(2, u'aaron'), (3, u'jacob')])
+    
+    def test_only_and_defer(self):
+        class F(FilterTool):
+            class Meta:
+                model = Book
+                fields = ['price']
+                only = ['title']
+        
+        f = F()
+        self.assertEqual([b.pk for b in f.qs], [1, 2, 3])
+        self.assertEqual(f.qs.query.deferred_loading, (set(['title']), False))
+        
+        
+        class F(FilterTool):
+            class Meta:
+                model = Book
+                fields = ['price']
+        
+        f = F({'price': '10'})
+        with self.assertNumQueries(2):
+            books = list(f.defer('title'))
+            self.assertEqual([b.pk for b in books], [1])
+            self.assertEqual(books[0].title, u"Ender's Game")
+
+
+class RelatedLoadingTest(FilterToolTestCase):
+    
+    def test_select_related(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['text']
+                select_related = ['author']
+        
+        with self.assertNumQueries(1):
+            authors = [c.author for c in F()]
+        self.assertEqual(authors, [self.alex, self.aaron, self.jacob])
+    
+    def test_prefetch_related(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+                prefetch_related = ['favorite_books']
+        
+        with self.assertNumQueries(2):
+            books = [list(u.favorite_books.all()) for u in F({'status': '0'})]
+        self.assertEqual(books, [[self.book1, self.book3], []])
+    
+    def test_ordering_selects_related(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['text']
+                order_by = ['author__username', 'text']
+        
+        with self.assertNumQueries(1):
+            authors = [c.author for c in F({'o': 'author__username'})]
+        self.assertEqual(authors, [self.aaron, self.alex, self.jacob])
+        self.assertFalse(F({'o': 'text'}).qs.query.select_related)
+    
+    def test_displayed_columns_select_related(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['text']
+                only = ['text', 'author__username']
+        
+        with self.assertNumQueries(1):
+            usernames = [c.author.username for c in F()]
+        self.assertEqual(usernames, ['alex', 'aaron', 'jacob'])
+        self.assertEqual(F().qs.query.select_related, {'author': {}})
+
+
+class IteratorTest(FilterToolTestCase):
+    
+    def test_iterator(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+                order_by = ['username']
+        
+        f = F({'o': 'username'})
+        self.assertEqual(list(f.iterator()), [self.aaron, self.alex, self.jacob])
+        self.assertEqual(f.qs._result_cache, None)
+    
+    def test_chunked(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+        
+        f = F({'status': '0'})
+        with self.assertNumQueries(1):
+            self.assertEqual(list(f.iterator(chunk_size=5)), [self.aaron, self.jacob])
+        with self.assertNumQueries(3):
+            self.assertEqual(list(f.iterator(chunk_size=1)), [self.aaron, self.jacob])
+        with self.assertNumQueries(2):
+            self.assertEqual(list(F().iterator(chunk_size=2)),
+                [self.alex, self.aaron, self.jacob])
+
+
+class LinkWidgetTest(RefineryTestCase):
+    
+    def test_render_keeps_other_params(self):
+        from django.http import QueryDict
+        w = LinkWidget(choices=STATUS_CHOICES_NONE)
+        w.value_from_datadict(QueryDict('status=1&page=2'), {}, 'status')
+        html = w.render('status', '1')
+        self.assertEqual(html.count('page=2'), 3)
+        self.assertTrue('<a href="?page=2">All</a>' in html)
+        self.assertTrue('status=0' in html)
+        self.assertEqual(html.count('class="selected"'), 1)
+        self.assertTrue('class="selected" href="?%s"' % QueryDict('status=1&page=2').urlencode() in html)
+    
+    def test_render_plain_dict(self):
+        w = LinkWidget(choices=STATUS_CHOICES)
+        w.data = {'status': u'0'}
+        self.assertEqual(w.render('status', '0'),
+            u'<ul>\n<li><a class="selected" href="?status=0">Regular</a></li>\n'
+            u'<li><a href="?status=1">Admin</a></li>\n</ul>')
+
+
+class FormCacheTest(FilterToolTestCase):
+    
+    def setUp(self):
+        super(FormCacheTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+    
+    def test_cached_render(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['author']
+                form_cache_timeout = 60
+        
+        html = F().rendered_form
+        self.assertTrue('<option value="3">jacob</option>' in html)
+        with self.assertNumQueries(0):
+            self.assertEqual(F().rendered_form, html)
+        self.assertTrue('selected="selected">aaron' in F({'author': '2'}).rendered_form)
+        self.assertEqual(F(prefix='p').rendered_form.count('id_p-author'), 2)
+        
+        User.objects.create(username='jose', status=0)
+        html = F().rendered_form
+        self.assertTrue('>jose</option>' in html)
+        with self.assertNumQueries(0):
+            self.assertEqual(F().rendered_form, html)
+    
+    def test_invalidation_without_render(self):
+        from django.db.models.signals import post_save
+        from refinery.cache import choices_versions
+        post_save.disconnect(sender=Book, dispatch_uid='refinery.cache:tests.book')
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+                form_cache_timeout = 60
+        
+        versions = choices_versions([Book])
+        Book.objects.create(title='Cryptonomicon', price=Decimal('12'), average_rating=4.5)
+        self.assertNotEqual(choices_versions([Book]), versions)
+    
+    def test_narrowed_choices(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['author']
+                form_cache_timeout = 60
+            
+            def __init__(self, data=None, user_status=None, **kwargs):
+                super(F, self).__init__(data, **kwargs)
+                self.filters['author'].extra['queryset'] = \
+                    User.objects.filter(status=user_status)
+        
+        self.assertTrue('>alex</option>' in F(user_status=1).rendered_form)
+        html = F(user_status=0).rendered_form
+        self.assertFalse('>alex</option>' in html)
+        self.assertTrue('>aaron</option>' in html)
+    
+    def test_language(self):
+        from django.utils import translation
+        from refinery.cache import form_cache_key
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['author']
+                form_cache_timeout = 60
+        
+        with translation.override('en'):
+            key = form_cache_key(F(), 'as_p')
+        with translation.override('de'):
+            self.assertNotEqual(form_cache_key(F(), 'as_p'), key)
+    
+    def test_uncached_render(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['author']
+        
+        with self.assertNumQueries(1):
+            F().rendered_form
+        with self.assertNumQueries(1):
+            F().rendered_form
+
+
+class SparseEvaluationTest(FilterToolTestCase):
+    
+    def test_only_submitted_filters_are_cleaned(self):
+        cleaned = []
+        
+        class CountingCharField(forms.CharField):
+            def clean(self, value):
+                cleaned.append(value)
+                return super(CountingCharField, self).clean(value)
+        
+        class CountingFilter(refinery.CharFilter):
+            field_class = CountingCharField
+        
+        class F(FilterTool):
+            username = CountingFilter()
+            first_name = CountingFilter()
+            last_name = CountingFilter()
+            price = refinery.RangeFilter(name='status')
+            class Meta:
+                model = User
+                fields = ['username', 'first_name', 'last_name', 'price', 'is_active']
+        
+        self.assertEqual(list(F()), [self.alex, self.aaron, self.jacob])
+        self.assertEqual(cleaned, [])
+        self.assertEqual(list(F({'username': 'alex'})), [self.alex])
+        self.assertEqual(cleaned, ['alex'])
+        self.assertEqual(list(F({'p-username': 'alex'}, prefix='p')), [self.alex])
+        self.assertEqual(cleaned, ['alex', 'alex'])
+        self.assertEqual(list(F({'price_0': '1', 'price_1': '2'})), [self.alex])
+        self.assertEqual(list(F({'is_active': '2'})), [self.jacob])
+        self.assertEqual(cleaned, ['alex', 'alex'])
+    
+    def test_initial_and_checkbox(self):
+        class F(FilterTool):
+            status = refinery.ChoiceFilter(choices=STATUS_CHOICES, initial=1)
+            is_active = refinery.BooleanFilter(widget=forms.CheckboxInput)
+            class Meta:
+                model = User
+                fields = ['status', 'is_active']
+        
+        self.assertEqual(list(F()), [self.alex])
+        self.assertEqual(list(F({})), [self.alex, self.aaron])
+
+
+class FromParamsTest(FilterToolTestCase):
+    
+    def test_simple(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'is_active', 'favorite_books']
+                order_by = ['username']
+        
+        f = F.from_params({'status': '0', 'o': 'username'})
+        self.assertEqual(list(f.qs), [self.aaron, self.jacob])
+        self.assertEqual(f.errors, {})
+        self.assertFalse(hasattr(f, '_form'))
+        self.assertEqual(list(F.from_params({'is_active': '2'})), [self.jacob])
+        self.assertEqual(list(F.from_params({'is_active': 'false'})), [self.alex, self.aaron])
+        self.assertEqual(list(F.from_params({'favorite_books': ['2']})), [self.alex])
+        
+        f = F.from_params({'status': '7', 'is_active': '1', 'o': 'status'})
+        self.assertEqual(f.errors, {'status': [u'Select a valid choice.']})
+        self.assertEqual(list(f), [self.alex, self.aaron, self.jacob])
+    
+    def test_querydict_and_prefix(self):
+        from django.http import QueryDict
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+        
+        f = F.from_params(QueryDict('p-favorite_books=1&p-favorite_books=3'), prefix='p')
+        self.assertEqual(list(f.qs), [self.alex, self.aaron])
+    
+    def test_coercers(self):
+        class F(FilterTool):
+            price = refinery.NumberFilter(lookup_type=['lt', 'gt'])
+            average_rating = refinery.RangeFilter()
+            class Meta:
+                model = Book
+                fields = ['price', 'average_rating']
+        
+        self.assertEqual(list(F.from_params({'price_0': '15', 'price_1': 'lt'})), [self.book1])
+        self.assertEqual(list(F.from_params({'price_0': '15'})), [self.book2])
+        self.assertEqual(list(F.from_params({'average_rating_0': '4.4',
+            'average_rating_1': '4.7'})), [self.book2])
+        f = F.from_params({'price_0': 'abc', 'average_rating_0': '4', 'average_rating_1': 'x'})
+        self.assertEqual(sorted(f.errors), ['average_rating', 'price'])
+        f = F.from_params({'price_0': '15', 'price_1': 'regex'})
+        self.assertEqual(f.errors, {'price': [u'Select a valid lookup type.']})
+        
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['date', 'time', 'author']
+        
+        self.assertEqual(list(F.from_params({'date': '2010-01-30'})), [self.comment1])
+        self.assertEqual(list(F.from_params({'time': '12:55'})), [self.comment3])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(F.from_params({'author': '2'}).qs), [self.comment2])
+        self.assertEqual(F.from_params({'author': 'x'}).errors,
+            {'author': [u'Select a valid choice.']})
+
+
+class OptimizerTest(FilterToolTestCase):
+    
+    def test_optimize_q(self):
+        from refinery.optimizer import optimize_q
+        q = optimize_q(Q() & (Q() | Q(status=1) | Q(status=1)) & Q(price__gte=5) & Q(price__lte=15))
+        self.assertEqual(q.connector, Q.AND)
+        self.assertEqual(q.children, [('status', 1), ('price__range', (5, 15))])
+        q = optimize_q(Q(price__gt=5) & Q(price__gte=7) & Q(price__lt=9))
+        self.assertEqual(q.children, [('price__gte', 7), ('price__lt', 9)])
+        q = optimize_q(Q(price__range=(5, 15)) & Q(price=10))
+        self.assertEqual(q.children, [('price__exact', 10)])
+        self.assertEqual(optimize_q(Q(price__gte=15) & Q(price__lte=5)), None)
+        self.assertEqual(optimize_q(Q(price__gt=5) & Q(price__lt=5)), None)
+        self.assertEqual(optimize_q(Q(is_active=True) & Q(is_active=False)), None)
+        q = optimize_q(Q(a=1) & (Q(b=2, c=3) | Q(b__gt=4, b__lt=2)))
+        self.assertEqual(sorted(q.children), [('a', 1), ('b', 2), ('c', 3)])
+        # values of different types, and negated nodes, are left alone
+        q = optimize_q(Q(price__gte='15') & Q(price__lte=5))
+        self.assertEqual(len(q.children), 2)
+        q = optimize_q(~Q(price__gte=15, price__lte=5))
+        self.assertTrue(q.negated)
+    
+    def test_filtertool(self):
+        class F(FilterTool):
+            price = refinery.OpenRangeNumericFilter()
+            min_price = refinery.NumberFilter(name='price', lookup_type='gte')
+            class Meta:
+                model = Book
+                fields = ['price', 'min_price']
+        
+        f = F({'price_0': '5', 'price_1': '15', 'min_price': '12'})
+        self.assertEqual(list(f.qs), [self.book2])
+        f = F({'price_0': '5', 'price_1': '15', 'min_price': '16'})
+        with self.assertNumQueries(0):
+            self.assertEqual(list(f.qs), [])
+
+
+class JoinEliminationTest(FilterToolTestCase):
+    
+    def test_trim_related_key(self):
+        from refinery.optimizer import trim_related_key
+        self.assertEqual(trim_related_key(Comment, 'author__id'), 'author')
+        self.assertEqual(trim_related_key(Comment, 'author__pk__in'), 'author__in')
+        self.assertEqual(trim_related_key(Comment, 'author__id__exact'), 'author__exact')
+        self.assertEqual(trim_related_key(Comment, 'author__username'), 'author__username')
+        self.assertEqual(trim_related_key(User, 'favorite_books__id'), 'favorite_books__id')
+        self.assertEqual(trim_related_key(User, 'comment__author__id'), 'comment__author')
+        self.assertEqual(trim_related_key(Comment, 'text'), 'text')
+        self.assertEqual(trim_related_key(Comment, 'missing__id'), 'missing__id')
+    
+    def test_filtertool(self):
+        class F(FilterTool):
+            author = refinery.NumberFilter(name='author__id', lookup_type='exact')
+            class Meta:
+                model = Comment
+                fields = ['author']
+        
+        f = F({'author': '2'})
+        self.assertEqual(list(f.qs), [self.comment2])
+        self.assertFalse('JOIN' in str(f.qs.query))
+
+
+class TrustedPksTest(FilterToolTestCase):
+    
+    def test_model_choice(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['author']
+                trusted_pks = True
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(list(F({'author': '2'}).qs), [self.comment2])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(F({'author': 'x'}).qs),
+                [self.comment1, self.comment2, self.comment3])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(F({'author': '9'}).qs), [])
+    
+    def test_model_multiple_choice(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+                trusted_pks = True
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(list(F({'favorite_books': ['1', '3']}).qs),
+                [self.alex, self.aaron])
+    
+    def test_constrained_to_queryset(self):
+        class F(FilterTool):
+            author = refinery.ModelChoiceFilter(trusted=True,
+                queryset=User.objects.filter(is_active=False))
+            class Meta:
+                model = Comment
+                fields = ['author']
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(list(F({'author': '2'}).qs), [self.comment2])
+        self.assertEqual(list(F({'author': '3'}).qs), [])
+    
+    def test_constrained_without_form(self):
+        class F(FilterTool):
+            author = refinery.ModelChoiceFilter(queryset=User.objects.filter(is_active=False))
+            class Meta:
+                model = Comment
+                fields = ['author']
+        
+        self.assertEqual(list(F.from_params({'author': '2'}).qs), [self.comment2])
+        self.assertEqual(list(F.from_params({'author': '3'}).qs), [])
+        self.assertEqual(list(F({'author': '3'}).qs),
+            [self.comment1, self.comment2, self.comment3])
+        
+        class G(FilterTool):
+            favorite_books = refinery.ModelMultipleChoiceFilter(
+                queryset=Book.objects.filter(price__lt=20))
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+        
+        self.assertEqual(list(G.from_params({'favorite_books': ['1', '3']}).qs),
+            [self.alex, self.aaron])
+        self.assertEqual(list(G.from_params({'favorite_books': ['3']}).qs), [])
+
+
+class ValuesChoicesTest(FilterToolTestCase):
+    
+    def test_label_field(self):
+        class F(FilterTool):
+            author = refinery.ModelChoiceFilter(queryset=User.objects.order_by('username'),
+                label_field='username')
+            class Meta:
+                model = Comment
+                fields = ['author']
+        
+        f = F({'author': '2'})
+        choices = list(f.form.fields['author'].widget.choices)
+        self.assertEqual(choices, [(u'', u'---------'), (2, u'aaron'), (1, u'alex'), (3, u'jacob')])
+        with self.assertNumQueries(1):
+            html = f.form['author'].as_widget()
+        self.assertTrue('<option value="2" selected="selected">aaron</option>' in html)
+        self.assertEqual(list(f.qs), [self.comment2])
+    
+    def test_label_format(self):
+        class F(FilterTool):
+            favorite_books = refinery.ModelMultipleChoiceFilter(
+                queryset=Book.objects.all(), label_field=('title', 'price'),
+                label_format=u'%s ($%s)')
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+        
+        f = F()
+        self.assertEqual(list(f.form.fields['favorite_books'].widget.choices),
+            [(1, u"Ender's Game ($10)"), (2, u'Rainbox Six ($15)'),
+             (3, u'Snowcrash ($20)')])
+        self.assertEqual(list(F({'favorite_books': ['2']}).qs), [self.alex])
+
+
+class LazyFilterToolTest(FilterToolTestCase):
+    
+    def test_lazy(self):
+        from refinery.filtertool import LazyBaseFilters
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status', 'favorite_books']
+                lazy = True
+        
+        self.assertTrue(isinstance(F.__dict__['base_filters'], LazyBaseFilters))
+        self.assertEqual(list(F({'status': '1'})), [self.alex])
+        self.assertEqual(F.__dict__['base_filters'].keys(), ['status', 'favorite_books'])
+        
+        class G(F):
+            username = refinery.CharFilter()
+        
+        self.assertEqual(G.base_filters.keys(), ['status', 'favorite_books', 'username'])
+    
+    def test_lazy_errors(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['name']
+                lazy = True
+        
+        msg = "Meta.fields contains a field that isn't defined on this FilterTool"
+        with self.assertRaisesRegexp(TypeError, msg):
+            F()
+        with self.assertRaisesRegexp(TypeError, msg):
+            F()
+
+
+class RegistryTest(FilterToolTestCase):
+    
+    def test_precompile(self):
+        from refinery import registry
+        from refinery.filtertool import LazyBaseFilters
+        class F(FilterTool):
+            price = refinery.NumberFilter(lookup_type=['lt', 'gt'])
+            class Meta:
+                model = Book
+                fields = ['price', 'title']
+                order_by = True
+                lazy = True
+        
+        self.assertTrue(F in registry.get_filtertools())
+        self.assertTrue(isinstance(F.__dict__['base_filters'], LazyBaseFilters))
+        with self.assertNumQueries(0):
+            self.assertTrue(F in registry.precompile())
+        self.assertEqual(F.__dict__['base_filters'].keys(), ['price', 'title'])
+        # the choices of order_by = True follow the filters of each instance
+        self.assertFalse('_ordering_choices' in F.__dict__)
+        self.assertEqual(F.base_filters['price'].__dict__['_lookup_choices'],
+            [('lt', 'lt'), ('gt', 'gt')])
+        self.assertEqual(list(F({'price_0': '15', 'price_1': 'lt', 'o': 'title'})), [self.book1])
+    
+    def test_dead_references(self):
+        import gc
+        from refinery import registry
+        gc.collect()
+        count = len(registry._filtertools)
+        for ndx in range(20):
+            class F(FilterTool):
+                class Meta:
+                    model = Book
+            del F
+        gc.collect()
+        self.assertEqual(len(registry._filtertools), count)
+    
+    def test_ordering_choices(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['username', 'status']
+                order_by = True
+            
+            def __init__(self, *args, **kwargs):
+                super(F, self).__init__(*args, **kwargs)
+                del self.filters['status']
+                self.filters['username'].label = 'Login'
+        
+        F.precompile()
+        f = F({'o': 'status'})
+        self.assertEqual(f.form.fields['o'].choices, [('username', 'Login')])
+        self.assertFalse(f.form.is_valid())
+        self.assertEqual(F({'o': 'username'}).form.is_valid(), True)
+        class G(FilterTool):
+            class Meta:
+                model = User
+                fields = ['username', 'status']
+                order_by = ['status']
+        
+        G.precompile()
+        self.assertEqual(G.__dict__['_ordering_choices'], [('status', u'Status')])
+    
+    def test_command(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('precompile_filtertools', stdout=out)
+        self.assertTrue(out.getvalue().startswith('Precompiled '))
+
+
+class CostGuardrailTest(FilterToolTestCase):
+    
+    def test_lookup_cost(self):
+        from refinery.cost import lookup_cost, query_cost
+        self.assertEqual(lookup_cost(User, 'username__exact'), (2, set()))
+        self.assertEqual(lookup_cost(User, 'id__regex'), (20, set()))
+        self.assertEqual(lookup_cost(User, 'favorite_books__title__icontains'),
+            (16, set(['favorite_books'])))
+        self.assertEqual(lookup_cost(Comment, 'author__username'), (2, set(['author'])))
+        self.assertEqual(lookup_cost(Comment, 'author__in'), (1, set()))
+        self.assertEqual(query_cost(User, Q(username='alex') | Q(comment__text__contains='x')),
+            (18, set(['comment'])))
+    
+    def test_allowed_lookups(self):
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type=None,
+                allowed_lookups=['exact', 'startswith'])
+            class Meta:
+                model = User
+                fields = ['username']
+        
+        f = F()
+        self.assertEqual(f.filters['username'].get_lookup_choices(),
+            [('exact', 'exact'), ('startswith', 'startswith')])
+        f = F({'username_0': 'al', 'username_1': 'regex'})
+        self.assertFalse(f.form.is_valid())
+        f = F.from_params({'username_0': 'al', 'username_1': 'regex'})
+        self.assertTrue('username' in f.errors)
+        f = F.from_params({'username_0': 'al', 'username_1': 'startswith'})
+        self.assertEqual(list(f), [User.objects.get(username='alex')])
+    
+    def test_reject(self):
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type=None)
+            class Meta:
+                model = User
+                fields = ['username', 'status']
+                max_cost = 10
+        
+        f = F({'username_0': 'alex', 'username_1': 'exact', 'status': '1'})
+        self.assertEqual([u.username for u in f], ['alex'])
+        self.assertFalse(f.over_budget)
+        f = F({'username_0': 'a', 'username_1': 'regex', 'status': '1'})
+        with self.assertNumQueries(0):
+            self.assertEqual(list(f.qs), [])
+        self.assertTrue(f.over_budget)
+    
+    def test_max_joins(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+                max_joins = 0
+        
+        f = F({'favorite_books': ['1']})
+        self.assertEqual(list(f.qs), [])
+        self.assertTrue(f.over_budget)
+    
+    def test_degrade(self):
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type=None)
+            class Meta:
+                model = User
+                fields = ['username', 'status']
+                max_cost = 10
+                cost_exceeded = 'degrade'
+        
+        f = F({'username_0': 'a', 'username_1': 'regex', 'status': '1'})
+        self.assertEqual([u.username for u in f], ['alex'])
+        self.assertFalse(f.over_budget)
+        self.assertEqual(f.dropped_filters, ['username'])
+
+
+class TimeoutTest(FilterToolTestCase):
+    # a condition which takes sqlite far longer than any test timeout
+    slow_where = ['(WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 '
+        'FROM c WHERE x < 100000000) SELECT count(*) FROM c) > 0']
+    
+    def test_statement_timeout(self):
+        from refinery.timeout import statement_timeout, QueryTimeout
+        qs = User.objects.extra(where=self.slow_where)
+        with self.assertRaises(QueryTimeout):
+            with statement_timeout(0.05):
+                qs.count()
+        # the limit only applies inside the block
+        with statement_timeout(0.05):
+            self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(User.objects.filter(status=1).count(), 1)
+    
+    def test_degrade(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+                timeout = 0.05
+        
+        f = F({'status': '0'}, queryset=User.objects.extra(where=self.slow_where))
+        self.assertEqual(f.count(), None)
+        self.assertTrue(f.timed_out)
+        self.assertEqual(f.fetch(0, 10), [])
+        self.assertEqual(list(f), [])
+        self.assertEqual(len(f), 0)
+        
+        f = F({'status': '0'})
+        self.assertEqual([u.username for u in f], ['aaron', 'jacob'])
+        self.assertEqual(f.count(), 2)
+        self.assertEqual([u.username for u in f.fetch(0, 1)], ['aaron'])
+        self.assertFalse(f.timed_out)
+    
+    def test_facet_counts(self):
+        from refinery.bitmap import BitmapIndex
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type='startswith')
+            class Meta:
+                model = User
+                fields = ['username', 'status']
+                timeout = 0.05
+        
+        index = BitmapIndex(F)
+        f = F({'username': 'a'}, queryset=User.objects.extra(where=self.slow_where))
+        self.assertEqual(f.facet_counts(index), {})
+        self.assertTrue(f.timed_out)
+        f = F({'username': 'a'})
+        self.assertEqual(f.facet_counts(index), {'status': {0: 1, 1: 1}})
+        self.assertFalse(f.timed_out)
+    
+    def test_timeout_argument(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+        
+        qs = User.objects.extra(where=self.slow_where)
+        f = F.from_params({'status': '0'}, queryset=qs, timeout=0.05)
+        self.assertEqual(f.fetch(), [])
+        self.assertTrue(f.timed_out)
+    
+    def test_view(self):
+        from django.test.client import RequestFactory
+        from refinery.views import BaseFilteredListView
+        class View(BaseFilteredListView):
+            model = User
+            queryset = User.objects.extra(where=self.slow_where)
+            filter_timeout = 0.05
+            def render_to_response(self, context):
+                return context
+        
+        context = View.as_view()(RequestFactory().get('/', {'status': '0'}))
+        self.assertEqual(list(context['object_list']), [])
+        self.assertTrue(context['filter'].timed_out)
+    
+    def test_count_limit(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+                count_limit = 1
+        
+        f = F({'status': '0'})
+        self.assertEqual(f.count(), 1)
+        self.assertTrue(f.count_truncated)
+        f = F({'status': '1'})
+        self.assertEqual(f.count(), 1)
+        self.assertFalse(f.count_truncated)
+
+
+class MemoryBackendTest(FilterToolTestCase):
+    
+    def setUp(self):
+        self.books = [
+            {'id': 1, 'title': u"Ender's Game", 'price': Decimal('10.00'), 'average_rating': 4.8},
+            {'id': 2, 'title': u'Rainbox Six', 'price': Decimal('15.00'), 'average_rating': 4.6},
+            {'id': 3, 'title': u'Snowcrash', 'price': Decimal('20.00'), 'average_rating': 4.3},
+        ]
+    
+    def test_compile_q(self):
+        from refinery.memory import compile_q
+        book = self.books[1]
+        self.assertTrue(compile_q(Q(title__istartswith='rain', price__gte=15))(book))
+        self.assertFalse(compile_q(Q(title__contains='rain'))(book))
+        self.assertTrue(compile_q(Q(price__range=(11, 16)) | Q(id=5))(book))
+        self.assertFalse(compile_q(~Q(id__in=[1, 2]))(book))
+        self.assertTrue(compile_q(Q(missing__isnull=True))(book))
+        user = User.objects.get(username='alex')
+        self.assertTrue(compile_q(Q(favorite_books__title__startswith='Rain'))(user))
+        self.assertFalse(compile_q(Q(favorite_books__title__startswith='Snow'))(user))
+        comment = Comment.objects.get(pk=1)
+        self.assertTrue(compile_q(Q(author=user))(comment))
+        self.assertTrue(compile_q(Q(author=user))({'author': user.pk}))
+        self.assertTrue(compile_q(Q(date__year=2010, author__username__iexact='ALEX'))(comment))
+    
+    def test_indexes(self):
+        from refinery.memory import MemoryBackend
+        backend = MemoryBackend(self.books, hash_indexes=['title'],
+            sorted_indexes=['price'])
+        self.assertEqual(backend.candidates(Q(title__in=['Snowcrash', 'Dune'])), set([2]))
+        self.assertEqual(backend.candidates(Q(price__gt=10, price__lte=20)), set([1, 2]))
+        self.assertEqual(backend.candidates(Q(price__lt=15) | Q(title='Snowcrash')), set([0, 2]))
+        self.assertEqual(backend.candidates(Q(price__lt=15) | Q(id=3)), None)
+        self.assertEqual(backend.candidates(Q(price__range=(12, 18), id__gt=0)), set([1]))
+        self.assertEqual([b['id'] for b in backend.filter(Q(price__gte=15, id__lt=3))], [2])
+        self.assertEqual([b['id'] for b in backend.filter(Q(id__gte=2))], [2, 3])
+    
+    def test_filtertool(self):
+        from refinery.memory import MemoryBackend
+        class F(FilterTool):
+            price = refinery.NumberFilter(lookup_type='lte')
+            class Meta:
+                model = Book
+                fields = ['title', 'price']
+                order_by = ['-price']
+        
+        backend = MemoryBackend(self.books, model=Book, sorted_indexes=['price'])
+        f = F({'price': '15', 'o': '-price'}, queryset=backend)
+        self.assertEqual([b['id'] for b in f], [2, 1])
+        self.assertEqual(len(f), 2)
+        self.assertEqual(f.count(), 2)
+        self.assertEqual([b['id'] for b in f.fetch(1)], [1])
+        f = F({'title': 'Snowcrash'}, queryset=self.books)
+        self.assertEqual([b['id'] for b in f], [3])
+    
+    def test_queryset_methods(self):
+        from django.db.models import Sum
+        class F(FilterTool):
+            price = refinery.NumberFilter(lookup_type='lte')
+            class Meta:
+                model = Book
+                fields = ['price']
+        
+        f = F({'price': '15'}, queryset=self.books)
+        self.assertEqual([b['id'] for b in f.iterator(chunk_size=1)], [1, 2])
+        self.assertEqual(f.values('id', 'title'), [
+            {'id': 1, 'title': u"Ender's Game"},
+            {'id': 2, 'title': u'Rainbox Six'},
+        ])
+        self.assertEqual(f.values_list('id', flat=True), [1, 2])
+        self.assertEqual(f.values_list('id', 'price'), [(1, Decimal('10.00')), (2, Decimal('15.00'))])
+        self.assertEqual(len(f.values()[0]), 4)
+        self.assertEqual([b['id'] for b in f.only('title')], [1, 2])
+        self.assertRaises(NotImplementedError, f.aggregate, Sum('price'))
+        self.assertEqual([b['id'] for b in f.qs.filter(price__gt=12)], [2])
+    
+    def test_model_instances(self):
+        class F(FilterTool):
+            class Meta:
+                model = Comment
+                fields = ['author']
+        
+        comments = list(Comment.objects.all())
+        with self.assertNumQueries(1):
+            # only the choices of the author field are queried
+            f = F({'author': '2'}, queryset=comments)
+            self.assertEqual([c.pk for c in f], [2])
+        f = F.from_params({'author': '3'}, queryset=comments)
+        self.assertEqual([c.pk for c in f], [3])
+    
+    def test_string_arguments(self):
+        from refinery.memory import MemoryBackend, compile_q
+        comments = list(Comment.objects.order_by('pk'))
+        def pks(q):
+            return [c.pk for c in comments if compile_q(q)(c)]
+        self.assertEqual(pks(Q(date__gte='2010-01-01')), [1, 2])
+        self.assertEqual(pks(Q(date__range=('2010-01-01', '2010-01-28'))), [2])
+        self.assertEqual(pks(Q(time__lt='12:55')), [1, 2])
+        self.assertEqual(pks(Q(author__gt='1')), [2, 3])
+        self.assertEqual(pks(Q(date__lt='soon')), [])
+        articles = list(Article.objects.order_by('pk'))
+        self.assertEqual([a.pk for a in articles if compile_q(Q(published__gte='2010-08-01'))(a)],
+            [2, 3])
+        class F(FilterTool):
+            date = refinery.DateRangeFilter()
+            class Meta:
+                model = Comment
+                fields = ['date']
+        self.assertEqual(list(F({'date': '2'}, queryset=comments)), [])
+        backend = MemoryBackend(User.objects.order_by('pk'), model=User,
+            sorted_indexes=['status', 'username'])
+        self.assertEqual([u.pk for u in backend.filter(status='1')], [1])
+        self.assertEqual([u.pk for u in backend.filter(status__gte='0', username__lt='b')], [1, 2])
+        self.assertEqual(backend.candidates(Q(status__lt='x')), None)
+
+
+class ColumnarBackendTest(FilterToolTestCase):
+    
+    def setUp(self):
+        from refinery import columnar
+        if columnar.numpy is None:
+            raise SkipTest('NumPy is not installed')
+    
+    def test_lookups(self):
+        from refinery.columnar import ColumnarBackend
+        backend = ColumnarBackend(User.objects.all(), model=User)
+        self.assertEqual(backend.columns['username'].categories, [u'aaron', u'alex', u'jacob'])
+        def usernames(**kwargs):
+            return [u.username for u in backend.filter(Q(**kwargs))]
+        self.assertEqual(usernames(username='alex'), ['alex'])
+        self.assertEqual(usernames(username='bob'), [])
+        self.assertEqual(usernames(username__startswith='a'), ['alex', 'aaron'])
+        self.assertEqual(usernames(username__gt='aaron', username__lt='jacob'), ['alex'])
+        self.assertEqual(usernames(username__lte='alex'), ['alex', 'aaron'])
+        self.assertEqual(usernames(status__in=['1', 5]), ['alex'])
+        self.assertEqual(usernames(is_active=True), ['jacob'])
+        self.assertEqual(usernames(id__range=(2, 3)), ['aaron', 'jacob'])
+        self.assertEqual([u.username for u in backend.filter(~Q(status=0) | Q(id=3))],
+            ['alex', 'jacob'])
+        with self.assertRaises(NotImplementedError):
+            backend.filter(Q(username__regex='a'))
+    
+    def test_temporal(self):
+        from refinery.columnar import ColumnarBackend
+        backend = ColumnarBackend(Comment.objects.values(), model=Comment)
+        def pks(**kwargs):
+            return [c['id'] for c in backend.filter(Q(**kwargs))]
+        self.assertEqual(pks(date=datetime.date(2010, 1, 30)), [1])
+        self.assertEqual(pks(date__gte=datetime.date(2010, 1, 30)), [1])
+        self.assertEqual(pks(time__lt=datetime.time(12, 55)), [1, 2])
+        self.assertEqual(pks(author=User.objects.get(pk=2)), [2])
+        self.assertEqual(pks(author__isnull=False), [1, 2, 3])
+        self.assertEqual(pks(date__gte='2010-01-01'), [1, 2])
+        self.assertEqual(pks(date__range=('2010-01-01', '2010-01-28')), [2])
+        self.assertEqual(pks(time__lt='12:55'), [1, 2])
+        self.assertRaises(ValueError, pks, date__lt='soon')
+        class F(FilterTool):
+            date = refinery.DateRangeFilter()
+            class Meta:
+                model = Comment
+                fields = ['date']
+        self.assertEqual(list(F({'date': '2'}, queryset=backend)), [])
+        articles = ColumnarBackend(Article.objects.all(), model=Article)
+        self.assertEqual([a.pk for a in articles.filter(published__gte='2010-08-01')], [2, 3])
+        self.assertEqual([a.pk for a in articles.filter(published__lt='2010-08-01 00:00:00')], [1])
+    
+    def test_filtertool(self):
+        from refinery.columnar import ColumnarBackend
+        class F(FilterTool):
+            price = refinery.RangeFilter()
+            class Meta:
+                model = Book
+                fields = ['price', 'title']
+                order_by = ['-price', 'title']
+        
+        backend = ColumnarBackend(Book.objects.values(), model=Book)
+        with self.assertNumQueries(0):
+            f = F({'price_0': '12', 'price_1': '20', 'o': '-price'}, queryset=backend)
+            self.assertEqual([b['title'] for b in f], [u'Snowcrash', u'Rainbox Six'])
+            self.assertEqual(f.count(), 2)
+            self.assertEqual([b['title'] for b in f[1:]], [u'Rainbox Six'])
+            f = F({'o': 'title'}, queryset=backend)
+            self.assertEqual([b['id'] for b in f], [1, 2, 3])
+            self.assertEqual([b['id'] for b in f.iterator(chunk_size=2)], [1, 2, 3])
+            self.assertEqual(f.values_list('title', flat=True)[:1], [u"Ender's Game"])
+            self.assertEqual([b['id'] for b in f.qs.filter(price__gt=12)], [2, 3])
+
+
+class BitmapIndexTest(FilterToolTestCase):
+    
+    def get_filtertool_class(self):
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type='startswith')
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'is_active']
+        return F
+    
+    def test_facet_counts(self):
+        from refinery.bitmap import BitmapIndex
+        F = self.get_filtertool_class()
+        index = BitmapIndex(F)
+        self.assertEqual(sorted(index.fields), ['is_active', 'status'])
+        with self.assertNumQueries(0):
+            self.assertEqual(F().facet_counts(index), {
+                'status': {0: 2, 1: 1},
+                'is_active': {True: 1, False: 2},
+            })
+            # a filter's own values are counted without it
+            self.assertEqual(F({'status': '0'}).facet_counts(index), {
+                'status': {0: 2, 1: 1},
+                'is_active': {True: 1, False: 1},
+            })
+        # filters which aren't indexed are evaluated by the database
+        with self.assertNumQueries(1):
+            self.assertEqual(F({'username': 'a', 'is_active': '3'}).facet_counts(index), {
+                'status': {0: 1, 1: 1},
+                'is_active': {True: 0, False: 2},
+            })
+    
+    def test_filter(self):
+        from refinery.bitmap import BitmapIndex
+        F = self.get_filtertool_class()
+        index = BitmapIndex(F)
+        with self.assertNumQueries(0):
+            self.assertEqual(index.filter(F({'status': '0', 'is_active': '3'})), [2])
+        self.assertEqual(index.filter(F({'username': 'j'})), [3])
+    
+    def test_signals(self):
+        from refinery.bitmap import BitmapIndex
+        F = self.get_filtertool_class()
+        index = BitmapIndex(F)
+        user = User.objects.get(username='jacob')
+        user.status = 1
+        user.save()
+        User.objects.get(username='alex').delete()
+        User.objects.create(username='bob', status=0, is_active=True)
+        self.assertEqual(F().facet_counts(index), {
+            'status': {0: 2, 1: 1},
+            'is_active': {True: 2, False: 1},
+        })
+        self.assertEqual(index.filter(F({'status': '1'})), [3])
+    
+    def test_queryset(self):
+        from refinery.bitmap import BitmapIndex
+        F = self.get_filtertool_class()
+        index = BitmapIndex(F, User.objects.filter(is_active=True))
+        User.objects.create(username='bob', status=0, is_active=False)
+        user = User.objects.get(username='alex')
+        user.is_active = True
+        user.save()
+        self.assertEqual(F().facet_counts(index), {
+            'status': {0: 1, 1: 1},
+            'is_active': {True: 2},
+        })
+        user.is_active = False
+        user.save()
+        self.assertEqual(index.filter(F()), [3])
+
+
+class RefineCacheTest(FilterToolTestCase):
+    
+    def setUp(self):
+        super(RefineCacheTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+    
+    def get_filtertool_class(self, **options):
+        options.setdefault('refine_cache_timeout', 60)
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type='startswith')
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'is_active']
+        F._meta.__dict__.update(options)
+        return F
+    
+    def get_sql(self, f):
+        from django.db import connection
+        from django.conf import settings
+        debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            start = len(connection.queries)
+            list(f.qs)
+            return [q['sql'] for q in connection.queries[start:]]
+        finally:
+            settings.DEBUG = debug
+    
+    def test_refinement(self):
+        F = self.get_filtertool_class()
+        sql = self.get_sql(F({'username': 'a'}))
+        # the matching keys are stored, then the rows fetched by key
+        self.assertEqual(len(sql), 2)
+        self.assertTrue('LIKE' in sql[0])
+        self.assertFalse('LIKE' in sql[1])
+        
+        f = F({'username': 'a', 'status': '0'})
+        sql = self.get_sql(f)
+        self.assertEqual([u.username for u in f], ['aaron'])
+        self.assertFalse('LIKE' in sql[0])
+        self.assertTrue('"status" = 0' in sql[0])
+        
+        # an exact match only needs the keys
+        f = F({'status': '0', 'username': 'a'})
+        sql = self.get_sql(f)
+        self.assertEqual(len(sql), 1)
+        self.assertFalse('"status" =' in sql[0])
+        self.assertEqual([u.username for u in f], ['aaron'])
+    
+    def test_invalidation(self):
+        F = self.get_filtertool_class()
+        self.assertEqual(len(F({'username': 'a'})), 2)
+        User.objects.create(username='adam', status=0)
+        f = F({'username': 'a', 'status': '0'})
+        self.assertEqual(sorted(u.username for u in f), ['aaron', 'adam'])
+    
+    def test_multivalued(self):
+        class F(FilterTool):
+            title = refinery.CharFilter(name='favorite_books__title')
+            price = refinery.NumberFilter(name='favorite_books__price')
+            class Meta:
+                model = User
+                fields = ['favorite_books']
+                refine_cache_timeout = 60
+        self.assertEqual(len(F({'title': "Ender's Game"})), 2)
+        # both conditions have to hold for the same book
+        self.assertEqual(list(F({'title': "Ender's Game", 'price': '15'}).qs), [])
+        self.assertEqual([u.pk for u in F({'favorite_books': ['3']}).qs], [2])
+        User.objects.get(pk=3).favorite_books.add(Book.objects.get(pk=3))
+        self.assertEqual(sorted(u.pk for u in F({'favorite_books': ['3']}).qs), [2, 3])
+    
+    def test_related_invalidation(self):
+        from refinery.cache import register_choice_model, choices_versions
+        class F(FilterTool):
+            author_name = refinery.CharFilter(name='author__username',
+                lookup_type='startswith')
+            class Meta:
+                model = Comment
+                fields = []
+                refine_cache_timeout = 60
+        self.assertEqual(len(F({'author_name': 'a'})), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(F({'author_name': 'a'}).qs), 2)
+        jacob = User.objects.get(pk=3)
+        jacob.username = 'adrian'
+        jacob.save()
+        self.assertEqual(len(F({'author_name': 'a'}).qs), 3)
+        
+        through = User.favorite_books.through
+        register_choice_model(through)
+        versions = choices_versions([through])
+        jacob.favorite_books.add(Book.objects.get(pk=3))
+        self.assertNotEqual(choices_versions([through]), versions)
+    
+    def test_max_size(self):
+        F = self.get_filtertool_class(refine_cache_max_size=1)
+        self.assertEqual(len(F({'username': 'a'})), 2)
+        sql = self.get_sql(F({'username': 'a', 'status': '0'}))
+        self.assertTrue('LIKE' in sql[0])
+    
+    def test_disabled(self):
+        F = self.get_filtertool_class(refine_cache_timeout=None)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(F({'username': 'a'})), 2)
+
+
+class SnapshotTest(FilterToolTestCase):
+    
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+    
+    def test_paging(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+                order_by = ['-username']
+        
+        snapshot = F({'status': '0', 'o': '-username'}).snapshot()
+        self.assertEqual(len(snapshot), 2)
+        # rows added or changed later don't move the pages
+        User.objects.create(username='zed', status=0)
+        User.objects.filter(username='jacob').update(status=1)
+        snapshot = F.get_snapshot(snapshot.cursor)
+        with self.assertNumQueries(1):
+            self.assertEqual([u.username for u in snapshot.page(0, 1)], ['jacob'])
+        self.assertEqual([u.username for u in snapshot.page(1, 2)], ['aaron'])
+        self.assertEqual(snapshot.page(2, 3), [])
+        User.objects.filter(username='aaron').delete()
+        self.assertEqual([u.username for u in snapshot.page(0, 2)], ['jacob'])
+    
+    def test_expired(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+        class G(FilterTool):
+            class Meta:
+                model = User
+        
+        snapshot = F({'status': '0'}).snapshot()
+        self.assertEqual(G.get_snapshot(snapshot.cursor), None)
+        self.assertEqual(F.get_snapshot('missing'), None)
+        from django.core.cache import cache
+        cache.clear()
+        self.assertEqual(F.get_snapshot(snapshot.cursor), None)
+    
+    def test_max_size(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+        
+        self.assertEqual(F({'status': '0'}).snapshot(max_size=1), None)
+        with self.assertNumQueries(1):
+            snapshot = F({'status': '0'}).snapshot(max_size=2)
+        self.assertEqual(len(F.get_snapshot(snapshot.cursor)), 2)
+
+
+class CountInWindowTest(FilterToolTestCase):
+    
+    def setUp(self):
+        from refinery.paginator import supports_window_functions
+        if not supports_window_functions():
+            raise SkipTest('The database has no window functions')
+    
+    def get_filtertool_class(self):
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'favorite_books']
+                order_by = ['username']
+        return F
+    
+    def test_fetch_with_count(self):
+        F = self.get_filtertool_class()
+        with self.assertNumQueries(1):
+            rows, count = F({'status': '0', 'o': 'username'}).fetch_with_count(0, 1)
+        self.assertEqual(([u.username for u in rows], count), (['aaron'], 2))
+        with self.assertNumQueries(1):
+            self.assertEqual(F({'username': 'nobody'}).fetch_with_count(0, 1), ([], 0))
+        # past the last row the count takes a query of its own
+        with self.assertNumQueries(2):
+            self.assertEqual(F({'status': '0'}).fetch_with_count(5, 6), ([], 2))
+        # joins to many rows repeat rows, which the window would count
+        f = F({'favorite_books': ['1', '2']})
+        f.qs
+        self.assertFalse(f.can_count_in_window())
+        with self.assertNumQueries(2):
+            rows, count = f.fetch_with_count(0, 10)
+        self.assertEqual(count, 2)
+    
+    def test_paginator(self):
+        from refinery.paginator import FilterToolPaginator
+        from django.core.paginator import EmptyPage
+        F = self.get_filtertool_class()
+        paginator = FilterToolPaginator(F({'o': 'username'}), 2)
+        with self.assertNumQueries(1):
+            page = paginator.page(2)
+            self.assertEqual([u.username for u in page.object_list], ['jacob'])
+            self.assertEqual(paginator.num_pages, 2)
+            self.assertFalse(page.has_next())
+        paginator = FilterToolPaginator(F({'o': 'username'}), 2, orphans=1)
+        with self.assertNumQueries(1):
+            page = paginator.page(1)
+            self.assertEqual(len(page.object_list), 3)
+        paginator = FilterToolPaginator(F(), 2)
+        with self.assertRaises(EmptyPage):
+            paginator.page(3)
+    
+    def test_view(self):
+        from django.test.client import RequestFactory
+        from refinery.views import BaseFilteredListView
+        F = self.get_filtertool_class()
+        class View(BaseFilteredListView):
+            model = User
+            filter_class = F
+            paginate_by = 2
+            def render_to_response(self, context):
+                return context
+        
+        request = RequestFactory().get('/', {'status': '0', 'page': '1'})
+        context = View.as_view()(request)
+        self.assertEqual(context['paginator'].count, 2)
+        request = RequestFactory().get('/', {'o': 'username', 'page': '2'})
+        context = View.as_view()(request)
+        self.assertEqual([u.username for u in context['object_list']], ['jacob'])
+        self.assertEqual(context['user_list'], context['object_list'])
+        
+        View.paginate_by = None
+        request = RequestFactory().get('/', {'status': '0', 'o': 'username'})
+        context = View.as_view()(request)
+        self.assertEqual([u.username for u in context['user_list']], ['aaron', 'jacob'])
+        self.assertTrue(context['object_list'] is context['filter'])
+    
+    def test_timeout(self):
+        F = self.get_filtertool_class()
+        qs = User.objects.extra(where=TimeoutTest.slow_where)
+        f = F({'status': '0'}, queryset=qs, timeout=0.05)
+        self.assertEqual(f.fetch_with_count(0, 10), ([], 0))
+        self.assertTrue(f.timed_out)
+    
+    def test_mysql_version(self):
+        from refinery.paginator import parse_mysql_version
+        self.assertEqual(parse_mysql_version('8.0.21'), (False, (8, 0)))
+        self.assertEqual(parse_mysql_version('5.7.30-log'), (False, (5, 7)))
+        self.assertEqual(parse_mysql_version('5.5.5-10.1.44-MariaDB'), (True, (10, 1)))
+        self.assertEqual(parse_mysql_version('10.2.32-MariaDB-1:10.2.32'), (True, (10, 2)))
+
+
+class AggregateTest(FilterToolTestCase):
+    
+    def test_aggregate(self):
+        from django.db.models import Avg, Max, Sum
+        class F(FilterTool):
+            price = refinery.NumberFilter(lookup_type='gte')
+            class Meta:
+                model = Book
+                fields = ['price']
+                aggregates = {'total': Sum('price'), 'rating': Avg('average_rating')}
+        
+        f = F({'price': '15'})
+        with self.assertNumQueries(1):
+            values = f.aggregate()
+            self.assertEqual(sorted(values), ['count', 'rating', 'total'])
+            self.assertEqual(values['total'], Decimal('35'))
+            self.assertAlmostEqual(values['rating'], 4.45)
+            self.assertEqual(len(f), 2)
+            self.assertEqual(f.count(), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(f.aggregate(Max('price'))['price__max'], Decimal('20'))
+            self.assertEqual(f.aggregate(Max('price'))['total'], Decimal('35'))
+        
+        f = F({'price': '15'})
+        with self.assertNumQueries(1):
+            self.assertEqual(len(f), 2)
+            self.assertEqual(f.aggregate()['total'], Decimal('35'))
+    
+    def test_empty(self):
+        from django.db.models import Sum
+        class F(FilterTool):
+            min_price = refinery.NumberFilter(name='price', lookup_type='gte')
+            max_price = refinery.NumberFilter(name='price', lookup_type='lte')
+            class Meta:
+                model = Book
+                fields = ['min_price', 'max_price']
+                aggregates = {'total': Sum('price')}
+        
+        f = F({'min_price': '20', 'max_price': '10'})
+        with self.assertNumQueries(0):
+            self.assertEqual(len(f), 0)
+            self.assertEqual(f.count(), 0)
+            self.assertEqual(f.aggregate(), {'total': None, 'count': 0})
+    
+    def test_without_meta(self):
+        from django.db.models import Min
+        class F(FilterTool):
+            class Meta:
+                model = User
+                fields = ['status']
+        
+        f = F({'status': '0'})
+        with self.assertNumQueries(1):
+            self.assertEqual(f.aggregate(first=Min('username')), {'first': 'aaron', 'count': 2})
+            self.assertEqual(len(f), 2)
+
+
+class BatchTest(FilterToolTestCase):
+    
+    def get_filtertool_class(self):
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type='startswith')
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'is_active', 'favorite_books']
+        return F
+    
+    def test_counts(self):
+        F = self.get_filtertool_class()
+        param_sets = [
+            {},
+            {'status': '0'},
+            {'username': 'a', 'status': '0'},
+            {'favorite_books': ['1']},
+            {'username': 'zzz'},
+            {'favorite_books': ['2', '3'], 'is_active': 'False'},
+        ]
+        self.assertEqual(F.batch_counts(param_sets), [3, 2, 1, 2, 0, 2])
+        self.assertEqual(F.batch_counts([]), [])
+        # the choices of the favorite_books filter aren't counted on
+        with self.assertNumQueries(1):
+            F.batch_counts(param_sets[:3])
+    
+    def test_queryset(self):
+        F = self.get_filtertool_class()
+        qs = User.objects.filter(is_active=False)
+        self.assertEqual(F.batch_counts([{}, {'status': '0'}], queryset=qs), [2, 1])
+        self.assertEqual(F.batch_pks([{}, {'status': '0'}], queryset=qs), [[1, 2], [2]])
+        qs = User.objects.filter(favorite_books__price__gte=10)
+        param_sets = [{}, {'status': '0'}, {'favorite_books': ['1']}, {'username': 'j'}]
+        self.assertEqual(F.batch_counts(param_sets, queryset=qs),
+            [F.from_params(params, queryset=qs).count() for params in param_sets])
+        self.assertEqual(F.batch_counts(param_sets, queryset=qs), [2, 1, 2, 0])
+    
+    def test_pks(self):
+        F = self.get_filtertool_class()
+        param_sets = [
+            {'status': '0'},
+            {'username': 'zzz'},
+            {'favorite_books': ['1']},
+            {},
+        ]
+        self.assertEqual(F.batch_pks(param_sets, limit=2), [[2, 3], [], [1, 2], [1, 2]])
+        with self.assertNumQueries(1):
+            F.batch_pks([{'status': '0'}, {'username': 'j'}])
+    
+    def test_many(self):
+        F = self.get_filtertool_class()
+        param_sets = [{'username': 'a', 'status': str(ndx % 2)} for ndx in range(600)]
+        self.assertEqual(F.batch_pks(param_sets), [[2], [1]] * 300)
+        self.assertEqual(F.batch_pks([{'status': '0'}] * 600, limit=1), [[2]] * 600)
+        self.assertEqual(F.batch_counts(param_sets), [1, 1] * 300)
+        self.assertEqual(F.batch_counts([{}] * 2500), [3] * 2500)
+    
+    def test_in_memory(self):
+        F = self.get_filtertool_class()
+        users = list(User.objects.all())
+        self.assertEqual(F.batch_counts([{}, {'username': 'al'}], queryset=users), [3, 1])
+        self.assertEqual(F.batch_pks([{'status': '0'}], queryset=users), [[2, 3]])
+
+
+class SavedSearchTest(FilterToolTestCase):
+    
+    def get_filtertool_class(self):
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type='startswith')
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'is_active']
+        return F
+    
+    def test_serialize(self):
+        from django.http import QueryDict
+        from refinery.saved import SavedSearch
+        search = SavedSearch(QueryDict('status=0&username=a&username=j'), 3)
+        self.assertEqual(search.params, {'status': '0', 'username': ['a', 'j']})
+        loaded = SavedSearch.loads(search.dumps())
+        self.assertEqual(loaded.params, search.params)
+        self.assertEqual(loaded.watermark, 3)
+        self.assertEqual(loaded.field, 'pk')
+        self.assertEqual(SavedSearch(QueryDict('username=')).params, {'username': u''})
+        search = SavedSearch({}, datetime.datetime(2010, 1, 2, 3, 4, 5, 678901), 'published')
+        loaded = SavedSearch.loads(search.dumps())
+        self.assertEqual(loaded.get_watermark(Article), search.watermark)
+    
+    def test_run(self):
+        from refinery.saved import SavedSearch, run_searches
+        F = self.get_filtertool_class()
+        searches = [
+            SavedSearch({'status': '0'}, 1),
+            SavedSearch({'username': 'a'}, 2),
+            SavedSearch({'is_active': 'True'}),
+        ]
+        with self.assertNumQueries(2):
+            self.assertEqual(run_searches(F, searches), [[2, 3], [], []])
+        self.assertEqual([s.watermark for s in searches], [3, 3, 3])
+        with self.assertNumQueries(1):
+            self.assertEqual(run_searches(F, searches), [[], [], []])
+        User.objects.create(username='adrian', status=0, is_active=True)
+        User.objects.create(username='jannis', status=1, is_active=True)
+        self.assertEqual(run_searches(F, searches), [[4], [4], [4, 5]])
+        self.assertEqual([s.watermark for s in searches], [5, 5, 5])
+        User.objects.get(pk=5).delete()
+        self.assertEqual(run_searches(F, searches), [[], [], []])
+        self.assertEqual([s.watermark for s in searches], [5, 5, 5])
+    
+    def test_limit(self):
+        from refinery.saved import SavedSearch, run_searches
+        F = self.get_filtertool_class()
+        search = SavedSearch({}, 0)
+        self.assertEqual(run_searches(F, [search], limit=2), [[1, 2]])
+        self.assertEqual(search.watermark, 2)
+        self.assertEqual(run_searches(F, [search], limit=2), [[3]])
+        self.assertEqual(search.watermark, 3)
+        self.assertEqual(run_searches(F, [search], limit=2), [[]])
+    
+    def test_many(self):
+        from refinery.saved import SavedSearch, run_searches
+        F = self.get_filtertool_class()
+        searches = [SavedSearch({'username': 'a', 'status': str(ndx % 2)}, 0)
+            for ndx in range(600)]
+        with self.assertNumQueries(4):
+            results = run_searches(F, searches, limit=10)
+        self.assertEqual(results, [[2], [1]] * 300)
+    
+    def test_timestamp(self):
+        from refinery.saved import SavedSearch, run_searches
+        class F(FilterTool):
+            class Meta:
+                model = Article
+                fields = ['author']
+        day = datetime.datetime(2011, 1, 1)
+        Article.objects.create(published=day, author_id=1)
+        search = SavedSearch({'author': '1'}, datetime.datetime(2010, 8, 1), 'published')
+        self.assertEqual(run_searches(F, [search]), [[2, Article.objects.latest('pk').pk]])
+        later = Article.objects.create(published=day + datetime.timedelta(seconds=1), author_id=1)
+        Article.objects.create(published=day + datetime.timedelta(seconds=2), author_id=2)
+        search = SavedSearch.loads(search.dumps())
+        self.assertEqual(run_searches(F, [search]), [[later.pk]])
+        self.assertRaises(ValueError, run_searches, F, [search], limit=10)
+        self.assertEqual(search.watermark, day + datetime.timedelta(seconds=2))
+
+
+class PercolatorTest(FilterToolTestCase):
+    
+    def get_percolator(self):
+        from refinery.percolator import Percolator
+        class F(FilterTool):
+            username = refinery.CharFilter(lookup_type='startswith')
+            class Meta:
+                model = User
+                fields = ['username', 'status', 'is_active', 'favorite_books']
+        percolator = Percolator(F)
+        percolator.add('admins', {'status': '1'})
+        percolator.add('regular', {'status': ['0'], 'is_active': 'True'})
+        percolator.add('a', {'username': 'a'})
+        percolator.add('inactive a', {'username': 'a', 'is_active': 'False'})
+        percolator.add('everyone', {})
+        return percolator
+    
+    def test_percolate(self):
+        percolator = self.get_percolator()
+        self.assertEqual(len(percolator), 5)
+        users = User.objects.in_bulk([1, 2, 3])
+        with self.assertNumQueries(0):
+            self.assertEqual(percolator.percolate(users[1]),
+                set(['admins', 'a', 'inactive a', 'everyone']))
+            self.assertEqual(percolator.percolate(users[2]),
+                set(['a', 'inactive a', 'everyone']))
+            self.assertEqual(percolator.percolate(users[3]),
+                set(['regular', 'everyone']))
+            self.assertEqual(percolator.percolate(User(username='anne', is_active=True)),
+                set(['regular', 'a', 'everyone']))
+    
+    def test_candidates(self):
+        percolator = self.get_percolator()
+        self.assertEqual(sorted(percolator.index), ['is_active', 'status'])
+        self.assertEqual(percolator.candidates(User.objects.get(pk=3)),
+            set(['regular', 'a', 'everyone']))
+    
+    def test_related(self):
+        percolator = self.get_percolator()
+        percolator.add('books', {'favorite_books': ['2', '3']})
+        self.assertEqual('books' in percolator.unindexed, True)
+        self.assertEqual('books' in percolator.percolate(User.objects.get(pk=1)), True)
+        self.assertEqual('books' in percolator.percolate(User.objects.get(pk=3)), False)
+    
+    def test_remove(self):
+        percolator = self.get_percolator()
+        percolator.add('admins', {'status': '0'})
+        self.assertEqual('admins' in percolator.percolate(User.objects.get(pk=2)), True)
+        percolator.remove('admins')
+        percolator.remove('regular')
+        self.assertEqual('admins' in percolator, False)
+        self.assertEqual(sorted(percolator.index), ['is_active'])
+        self.assertEqual(percolator.percolate(User.objects.get(pk=1)),
+            set(['a', 'inactive a', 'everyone']))
+    
+    def test_string_arguments(self):
+        from refinery.percolator import Percolator
+        class F(FilterTool):
+            date = refinery.DateRangeFilter()
+            class Meta:
+                model = Comment
+                fields = ['date', 'author']
+        percolator = Percolator(F)
+        percolator.add('week', {'date': '2'})
+        percolator.add('aaron', {'author': '2', 'date': '2'})
+        comment = Comment.objects.get(pk=2)
+        self.assertEqual(percolator.percolate(comment), set())
+        comment.date = datetime.date.today()
+        self.assertEqual(percolator.percolate(comment), set(['week', 'aaron']))
+        q = percolator.convert_q(Q(date__range=('2010-01-01', '2010-01-31'), author__in=['2']))
+        self.assertEqual(sorted(q.children), [
+            ('author__in', [2]),
+            ('date__range', [datetime.date(2010, 1, 1), datetime.date(2010, 1, 31)]),
+        ])